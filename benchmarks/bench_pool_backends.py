@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+"""compare pool_call backends on typical workloads
+
+usage: python benchmarks/bench_pool_backends.py [ntasks] [max_workers]
+
+subprocess: each task runs a short pipeline (waits on a child process)
+python: each task does pure python arithmetic (holds the GIL)
+trivial: each task returns immediately (measures dispatch overhead)
+
+the thread backend wins when tasks wait on subprocesses or are trivial,
+the process backend wins once tasks do substantial work in python.
+"""
+import sys
+import time
+
+import clasp.script_tools as cst
+
+
+def subprocess_task(i):
+    return cst.pipeline(["sh -c 'sleep 0.02; echo {}'".format(i)])
+
+
+def python_task(i):
+    return sum(j * j for j in range(200000))
+
+
+def trivial_task(i):
+    return i
+
+
+def bench(func, n, backend, **kwargs):
+    cst.shutdown_pool()
+    start = time.perf_counter()
+    cst.pool_call(func, range(n), backend=backend, **kwargs)
+    return time.perf_counter() - start
+
+
+def main(n=64, max_workers=None):
+    print("{:<12} {:>10} {:>10}".format("workload", "process", "thread"))
+    for name, func in (("subprocess", subprocess_task),
+                       ("python", python_task), ("trivial", trivial_task)):
+        times = [bench(func, n, backend, max_workers=max_workers)
+                 for backend in ('process', 'thread')]
+        print("{:<12} {:>9.3f}s {:>9.3f}s".format(name, *times))
+
+
+if __name__ == '__main__':
+    main(*[int(i) for i in sys.argv[1:]])
@@ -6,7 +6,7 @@ __author__ = """Stephen Wasilewski"""
 __email__ = 'stephanwaz@gmail.com'
 __version__ = '1.1.10'
 __all__ = ['script_tools', 'click_ext', 'sphinx_click_ext', 'templates',
-           'click']
+           'cluster', 'click']
 
 import click
 import clasp.click_ext
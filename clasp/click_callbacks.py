@@ -44,6 +44,11 @@ callback handles) using glob plus the following:
     * tup_float: parses float tuples from comma/space separated string
     * split_float: splits list of floats and extends ranges based on : notation
     * split_int: splits list of ints and extends ranges based on : notation
+
+**Execution**
+
+    * set_jobs: set the process-wide limit on parallel tasks
+      (see script_tools.set_jobs)
 """
 
 import os
@@ -357,6 +362,14 @@ def split_int(ctx, param, s):
     return result
 
 
+def set_jobs(ctx, param, s):
+    """set the process-wide limit on parallel tasks"""
+    if s is not None and s < 1:
+        callback_error(s, param, '4')
+    cst.set_jobs(s)
+    return s
+
+
 def data_stream(ctx, param, s):
     if s in [None, 'None', 'none']:
         result = None
@@ -290,6 +290,10 @@ def command_decs(v, wrap=False):
                        help="check parsed options"),
           click.option('--debug', is_flag=True,
                        help="show traceback on exceptions"),
+          click.option('--jobs', '-j', type=int, callback=set_jobs,
+                       expose_value=False, is_eager=True,
+                       help="maximum number of parallel tasks (default: "
+                       "share the jobserver of make -j, or no limit)"),
           click.version_option(version=v),
           click.pass_context
     ]
@@ -0,0 +1,339 @@
+# Copyright (c) 2018 Stephen Wasilewski
+# =======================================================================
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+# =======================================================================
+
+"""execute pool_call and cluster_call tasks on other machines
+
+start a worker daemon on each node (the same python environment and
+modules must be installed and shared paths mounted at the same location)::
+
+    clasp_worker --port 6150 --authkey secret
+
+then pass a ClusterExecutor as the backend::
+
+    nodes = ClusterExecutor(['node1:6150', 'node2:6150'], b'secret')
+    pool_call(func, args, backend=nodes)
+
+tasks are pickled, so func must be importable on the nodes (no lambdas or
+functions defined in __main__). anyone with the authkey can execute code on
+the nodes, only listen on trusted networks.
+"""
+import collections
+import itertools
+import os
+import pickle
+import threading
+from concurrent.futures import Executor, Future
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.connection import Listener, Client, AuthenticationError
+
+import clasp
+from clasp import click
+import clasp.click_ext as clk
+import clasp.script_tools as cst
+
+try:
+    from concurrent.futures import BrokenExecutor
+except ImportError:
+    BrokenExecutor = RuntimeError
+
+#: port used by clasp_worker and node addresses without one
+default_port = 6150
+
+
+def parse_address(node):
+    """return (host, port) from 'host:port', 'host' or (host, port)"""
+    if not isinstance(node, str):
+        return tuple(node)
+    host, _, port = node.rpartition(':')
+    if not host:
+        return node, default_port
+    return host, int(port)
+
+
+def _reply(send, i, future):
+    """send the outcome of a task back to the client"""
+    ex = future.exception()
+    try:
+        if ex is None:
+            send(('result', i, future.result()))
+        else:
+            send(('error', i, ex))
+    except OSError:
+        pass
+    except Exception as err:
+        # result or exception could not be pickled
+        send(('error', i, RuntimeError(repr(ex or err))))
+
+
+def _handle(conn, executor, workers, heartbeat):
+    """serve one client connection of a worker daemon"""
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def send(msg):
+        with lock:
+            conn.send(msg)
+
+    def beat():
+        while not stop.wait(heartbeat):
+            try:
+                send(('alive',))
+            except OSError:
+                return
+
+    try:
+        send(('hello', workers, heartbeat))
+        threading.Thread(target=beat, daemon=True).start()
+        while True:
+            msg = conn.recv()
+            if msg[0] == 'close':
+                break
+            i = msg[1]
+            try:
+                func, args, kwargs = pickle.loads(msg[2])
+                future = executor[0].submit(func, *args, **kwargs)
+            except BrokenProcessPool:
+                executor[0] = cst.backends[executor[1]](max_workers=workers)
+                future = executor[0].submit(func, *args, **kwargs)
+            except Exception as ex:
+                future = Future()
+                future.set_exception(ex)
+            future.add_done_callback(lambda f, i=i: _reply(send, i, f))
+    except (EOFError, OSError):
+        pass
+    finally:
+        stop.set()
+        conn.close()
+
+
+def serve(address=('', default_port), authkey=None, workers=None,
+          backend='process', heartbeat=1.0):
+    """run a worker daemon executing tasks sent by ClusterExecutor clients
+
+    does not return, each client connection is served by its own thread and
+    tasks of all clients share one pool.
+
+    Parameters
+    ----------
+    address: tuple or multiprocessing.connection.Listener
+        (host, port) to listen on, or a listener to accept clients from
+    authkey: bytes
+        shared secret clients must present
+    workers: int
+        number of tasks executed at once (defaults to cpu count)
+    backend: str
+        'process' or 'thread' executor running the tasks
+    heartbeat: float
+        seconds between messages telling clients the node is alive
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    if isinstance(address, Listener):
+        listener = address
+    else:
+        listener = Listener(address, authkey=authkey)
+    executor = [cst.backends[backend](max_workers=workers), backend]
+    try:
+        while True:
+            try:
+                conn = listener.accept()
+            except AuthenticationError:
+                continue
+            threading.Thread(target=_handle, daemon=True,
+                             args=(conn, executor, workers, heartbeat)).start()
+    finally:
+        listener.close()
+        executor[0].shutdown(wait=False)
+
+
+class _Node(object):
+    """connection to a worker daemon"""
+
+    def __init__(self, address, authkey):
+        self.address = address
+        self.conn = Client(address, authkey=authkey)
+        _, self.workers, self.heartbeat = self.conn.recv()
+        self.inflight = {}
+        self.alive = True
+
+
+class ClusterExecutor(Executor):
+    """concurrent.futures executor distributing tasks to worker daemons
+
+    use as the backend of pool_call, pool_imap or cluster_call. each node
+    runs up to its number of workers tasks at once. if a node disconnects or
+    misses heartbeats its unfinished tasks are requeued on the other nodes,
+    once none are left pending futures fail with BrokenExecutor.
+
+    Parameters
+    ----------
+    nodes: list
+        addresses of worker daemons ('host:port', 'host' or (host, port))
+    authkey: bytes
+        shared secret of the daemons
+    timeout: float
+        seconds without a message before a node is considered dead (defaults
+        to 4 heartbeats of the node)
+    """
+
+    def __init__(self, nodes, authkey, timeout=None):
+        self._cond = threading.Condition()
+        self._queue = collections.deque()
+        self._ids = itertools.count()
+        self._shutdown = False
+        self._timeout = timeout
+        self._nodes = []
+        errors = []
+        for node in nodes:
+            try:
+                self._nodes.append(_Node(parse_address(node), authkey))
+            except (OSError, EOFError, AuthenticationError) as ex:
+                errors.append("{}: {}".format(node, ex))
+        if not self._nodes:
+            raise OSError("no worker daemon reachable: " + "; ".join(errors))
+        self._max_workers = sum(node.workers for node in self._nodes)
+        self._threads = []
+        for node in self._nodes:
+            for target in (self._sender, self._receiver):
+                thread = threading.Thread(target=target, args=(node,),
+                                          daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    @property
+    def nodes(self):
+        """addresses of the connected nodes"""
+        return [node.address for node in self._nodes if node.alive]
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError('cannot schedule new futures after '
+                                   'shutdown')
+            if not self.nodes:
+                raise BrokenExecutor('all worker daemons are lost')
+            self._queue.append((future, fn, args, kwargs, False))
+            self._cond.notify_all()
+        return future
+
+    def _sender(self, node):
+        """send queued tasks while node has free workers"""
+        while True:
+            with self._cond:
+                while node.alive and not self._shutdown and (
+                        not self._queue or
+                        len(node.inflight) >= node.workers):
+                    self._cond.wait()
+                if not node.alive or self._shutdown:
+                    return
+                task = self._queue.popleft()
+                if not task[4] and not task[0].set_running_or_notify_cancel():
+                    continue
+                i = next(self._ids)
+                node.inflight[i] = task
+            try:
+                node.conn.send(('task', i, pickle.dumps(task[1:4])))
+            except (OSError, ValueError):
+                self._lost(node)
+                return
+            except Exception as ex:
+                # task could not be pickled
+                with self._cond:
+                    node.inflight.pop(i, None)
+                    self._cond.notify_all()
+                task[0].set_exception(ex)
+
+    def _receiver(self, node):
+        """set results of finished tasks, detect lost node"""
+        timeout = self._timeout or 4 * node.heartbeat
+        while True:
+            try:
+                if not node.conn.poll(timeout):
+                    raise EOFError('no heartbeat')
+                msg = node.conn.recv()
+            except (EOFError, OSError):
+                self._lost(node)
+                return
+            if msg[0] == 'alive':
+                continue
+            with self._cond:
+                task = node.inflight.pop(msg[1], None)
+                self._cond.notify_all()
+            if task is None:
+                continue
+            if msg[0] == 'result':
+                task[0].set_result(msg[2])
+            else:
+                task[0].set_exception(msg[2])
+
+    def _lost(self, node):
+        """requeue unfinished tasks of node and close its connection"""
+        with self._cond:
+            if not node.alive:
+                return
+            node.alive = False
+            node.conn.close()
+            tasks = list(node.inflight.values())
+            node.inflight.clear()
+            if self.nodes:
+                # already running, so skip set_running_or_notify_cancel
+                for task in reversed(tasks):
+                    self._queue.appendleft(task[:4] + (True,))
+            else:
+                tasks += list(self._queue)
+                self._queue.clear()
+                for future, *_ in tasks:
+                    if not future.done():
+                        future.set_exception(BrokenExecutor(
+                            'all worker daemons are lost'))
+            self._cond.notify_all()
+
+    def shutdown(self, wait=True):
+        with self._cond:
+            self._shutdown = True
+            if wait:
+                while self.nodes and (self._queue or any(
+                        node.inflight for node in self._nodes)):
+                    self._cond.wait()
+            for future, *_ in self._queue:
+                future.cancel()
+            self._queue.clear()
+            self._cond.notify_all()
+        for node in self._nodes:
+            if node.alive:
+                try:
+                    node.conn.send(('close',))
+                except OSError:
+                    pass
+                node.alive = False
+                node.conn.close()
+
+
+@click.command()
+@click.option('--host', default='',
+              help="address to listen on (default all interfaces)")
+@click.option('--port', default=default_port, type=int)
+@click.option('--authkey', envvar='CLASP_AUTHKEY', required=True,
+              help="shared secret of clients (or set CLASP_AUTHKEY)")
+@click.option('--workers', type=int,
+              help="tasks to run at once (default cpu count)")
+@click.option('--backend', type=click.Choice(['process', 'thread']),
+              default='process')
+@clk.shared_decs(clk.command_decs(clasp.__version__))
+def main(ctx, host, port, authkey, workers, backend, **kwargs):
+    """run a worker daemon for ClusterExecutor"""
+    if kwargs['opts']:
+        kwargs['opts'] = False
+        clk.echo_args(host, port, workers, backend, **kwargs)
+    else:
+        try:
+            serve((host, port), authkey.encode(), workers, backend)
+        except click.Abort:
+            raise
+        except Exception as ex:
+            clk.print_except(ex, kwargs['debug'])
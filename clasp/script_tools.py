@@ -16,9 +16,41 @@ from glob import glob
 import os
 import re
 import math
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import asyncio
+import io
+import threading
+import hashlib
+import pickle
+import json
+import contextlib
+import time
+import atexit
+import itertools
+import array
+import collections
+import select
+import weakref
+from concurrent.futures import (Executor, ProcessPoolExecutor,
+                                ThreadPoolExecutor, as_completed, wait,
+                                FIRST_COMPLETED)
+from concurrent.futures.process import BrokenProcessPool
 from clasp import click
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    shared_memory = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 
 encoding = sys.stdin.encoding
 if encoding is None:
@@ -70,36 +102,81 @@ def warn_match(kwargs, sargs):
             click.echo('WARNING: {} not set'.format(i), err=True)
 
 
+class ArgBinder(object):
+    """argument names and defaults of func, inspected once for kwarg_match,
+    arg_match and kwarg_arg (get with arg_binder)"""
+
+    def __init__(self, func):
+        spec = inspect.getfullargspec(func)
+        self.args = spec.args
+        self.defaults = spec.defaults or ()
+        self.optional = self.args[len(self.args) - len(self.defaults):]
+        self._source = (getattr(func, '__code__', None),
+                        getattr(func, '__defaults__', None))
+
+    def current(self, func):
+        """check that func was not redefined since inspection"""
+        return (self._source[0] is getattr(func, '__code__', None) and
+                self._source[1] is getattr(func, '__defaults__', None))
+
+    def kwarg_match(self, kwargs, debug=False):
+        argsc = {i: kwargs[i] for i in self.args if i in kwargs}
+        if debug:
+            warn_match(kwargs, self.args)
+        return argsc
+
+    def arg_match(self, kwargs, *args):
+        return list(args) + [kwargs[i] if i in kwargs else None
+                             for i in self.args[len(args):]]
+
+    def kwarg_arg(self, kwargs, skip=None):
+        if skip is None:
+            oargs = self.optional
+        else:
+            oargs = self.args[skip:]
+        largs = []
+        for oarg, default in zip(oargs, self.defaults):
+            try:
+                largs.append(kwargs[oarg])
+            except Exception:
+                largs.append(default)
+        return largs
+
+
+_binders = weakref.WeakKeyDictionary()
+
+
+def arg_binder(func):
+    """return the ArgBinder of func, cached while func exists"""
+    # bound methods are created on each access, their function is not
+    key = getattr(func, '__func__', func)
+    try:
+        binder = _binders.get(key)
+    except TypeError:
+        binder = None
+    if binder is None or not binder.current(func):
+        binder = ArgBinder(func)
+        try:
+            _binders[key] = binder
+        except TypeError:
+            # no weak references to builtins, inspect on every call
+            pass
+    return binder
+
+
 def kwarg_match(func, kwargs, debug=False):
     """filters dict for keys used by func"""
-    sargs = inspect.getfullargspec(func).args
-    argsc = {i: kwargs[i] for i in sargs if i in kwargs}
-    if debug:
-        warn_match(kwargs, sargs)
-    return argsc
+    return arg_binder(func).kwarg_match(kwargs, debug)
 
 
 def arg_match(func, kwargs, *args):
     """filters dict for positional arguments used by func"""
-    sargs = inspect.getfullargspec(func).args[len(args):]
-    argsc = list(args) + [kwargs[i] if i in kwargs else None for i in sargs]
-    return argsc
+    return arg_binder(func).arg_match(kwargs, *args)
 
 
 def kwarg_arg(func, kwargs, skip=None):
     """returns ordered list of optional arg values"""
-    spec = inspect.getfullargspec(func)
-    if skip is not None:
-        oargs = spec.args[skip:]
-    else:
-        oargs = spec.args[-len(spec.defaults):]
-    largs = []
-    for oarg, default in zip(oargs, spec.defaults):
-        try:
-            largs.append(kwargs[oarg])
-        except Exception:
-            largs.append(default)
-    return largs
+    return arg_binder(func).kwarg_arg(kwargs, skip)
 
 
 def crossref(l1, l2):
@@ -112,81 +189,489 @@ def crossref(l1, l2):
     return [flat_list(i) for i in out]
 
 
-def crossref_all(l, followers=[]):
-    '''return all possible combos of list of lists'''
-    la = []
-    followed = [i[0] for i in followers]
-    follows = [i[1] for i in followers]
-    leaders = [i for i in range(len(l)) if i not in follows]
-    for i in leaders:
-        if i == 0:
+class CrossRef(object):
+    """lazy sequence of all combos of list of lists (the rows of
+    crossref_all)
+
+    combos are computed from their index on demand, so any sweep can be
+    iterated, counted with len and accessed (or sharded) by index without
+    building it. the last leader varies fastest.
+
+    Parameters
+    ----------
+    l: list of lists
+        values of each parameter
+    followers: list of tuples
+        (leader, follower) index pairs, a follower takes the value at the same
+        position as its leader instead of adding a dimension. its value comes
+        right after the leader's in each combo.
+    """
+
+    def __init__(self, l, followers=[]):
+        l = [list(i) for i in l]
+        followed = [i[0] for i in followers]
+        follows = [i[1] for i in followers]
+        self.columns = []
+        self.groups = []
+        for i in range(len(l)):
+            if i in follows:
+                continue
             if i in followed:
                 k = follows[followed.index(i)]
-                try:
-                    la = [[lb, l[k][j]] for j, lb in enumerate(l[i])]
-                except Exception:
+                if len(l[k]) < len(l[i]):
                     click.echo('length of follower must match lead', err=True)
                     raise click.Abort()
+                self.columns += [i, k]
+                self.groups.append(list(zip(l[i], l[k])))
             else:
-                la = l[i]
+                self.columns.append(i)
+                self.groups.append([(j,) for j in l[i]])
+        self._len = int(len(self.groups) > 0)
+        for group in self.groups:
+            self._len *= len(group)
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._len))]
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError('CrossRef index out of range')
+        combo = []
+        for group in reversed(self.groups):
+            index, j = divmod(index, len(group))
+            combo.append(group[j])
+        return tuple(itertools.chain.from_iterable(reversed(combo)))
+
+    def __iter__(self):
+        if not self.groups:
+            return iter(())
+        return (tuple(itertools.chain.from_iterable(i))
+                for i in itertools.product(*self.groups))
+
+
+def crossref_all(l, followers=[]):
+    '''return all possible combos of list of lists as one tuple per
+    parameter (in order of CrossRef columns)'''
+    return list(zip(*CrossRef(l, followers)))
+
+
+class _Substitution(object):
+    """process substitution from subpipe exposed to a command as /dev/fd/N
+
+    holds the read end of the pipe until the consuming command has been
+    started (release) and the substituted processes until they exit (clean).
+    """
+
+    def __init__(self, fd, pops, temps):
+        self.fd = fd
+        self.pops = pops
+        self.temps = temps
+
+    def release(self):
+        """close the parent's copy of the read end"""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def clean(self):
+        self.release()
+        for p in self.pops:
+            p.wait()
+        _clean_temps(self.temps)
+
+
+def _release_fds(temps):
+    """close parent copies of process substitution pipes from subpipe"""
+    for temp in temps:
+        if isinstance(temp, _Substitution):
+            temp.release()
+
+
+def _clean_temps(temps):
+    """remove temp files and reap process substitutions from subpipe"""
+    for temp in temps:
+        if isinstance(temp, _Substitution):
+            temp.clean()
         else:
-            if i in followed:
-                lb = crossref(la, list(range(len(l[i]))))
-                k = follows[followed.index(i)]
-                try:
-                    la = [j[:-1] + [l[i][j[-1]], l[k][j[-1]]] for j in lb]
-                except IndexError:
-                    click.echo('length of follower must match lead', err=True)
-                    raise click.Abort()
-            else:
-                la = crossref(la, l[i])
-    return list(zip(*la))
+            os.remove(temp)
+
+
+def _subfds(temps):
+    """read ends of process substitution pipes created by subpipe"""
+    return {temp.fd for temp in temps
+            if isinstance(temp, _Substitution) and temp.fd is not None}
+
+
+def _devfds(command, fds):
+    """file descriptors of fds a command references as /dev/fd/N, only
+    these are passed to the child (not other descriptors of the parent)"""
+    return tuple(int(i) for i in re.findall(r'/dev/fd/(\d+)', command)
+                 if int(i) in fds)
+
+
+def _fdsub(command):
+    """start command writing to a pipe, return a _Substitution"""
+    temps, commands = subpipe([command], fdsub=True)
+    rfd, wfd = os.pipe()
+    try:
+        pops = _spawn_pipeline(commands, None, wfd, fds=_subfds(temps))
+    finally:
+        os.close(wfd)
+        _release_fds(temps)
+    return _Substitution(rfd, pops, temps)
+
+
+def _scan_subs(command):
+    """locate outermost $(...) spans and the | separators outside of them
+
+    Returns
+    -------
+    spans: list
+        (start, end) index of each outermost $(...)
+    pipes: list
+        index of each | not enclosed in a $(...)
+    """
+    spans = []
+    pipes = []
+    depth = 0
+    start = 0
+    for k, c in enumerate(command):
+        if c == "(":
+            if depth > 0:
+                depth += 1
+            elif command[k-1:k] == "$":
+                start = k - 1
+                depth = 1
+        elif c == ")" and depth > 0:
+            depth -= 1
+            if depth == 0:
+                spans.append((start, k + 1))
+        elif c == "|" and depth == 0:
+            pipes.append(k)
+    return spans, pipes
+
+
+def _split_pipes(command):
+    """split command on | (ignoring | inside $(...))"""
+    _, pipes = _scan_subs(command)
+    bounds = [-1] + pipes + [len(command)]
+    return [command[i+1:j] for i, j in zip(bounds[:-1], bounds[1:])]
+
+
+def _arith(command):
+    """evaluate $((expression)) in place (innermost first)"""
+    while "$((" in command:
+        si = command.rfind("$((")
+        op = 2
+        sj = si+3
+        for s in command[sj:]:
+            if op == 0:
+                break
+            if s == "(":
+                op += 1
+            if s == ")":
+                op -= 1
+            sj += 1
+        try:
+            exp = command[si+1:sj]
+            command = command[:si] + str(eval(exp, {}, {})) + command[sj:]
+        except Exception:
+            click.echo("bad expression: {}".format(exp))
+            raise click.Abort
+    return command
+
 
+def _run_subs(subs, jobs=None):
+    """execute (command, path) substitutions to temp files concurrently
 
-def subpipe(commands):
+    at most jobs substitutions (all if None) run at once, when the limit is
+    reached the oldest is waited on before starting the next.
+    """
+    running = []
+
+    def finish(sub):
+        pops, temps = sub
+        for p in pops:
+            p.wait()
+        _clean_temps(temps)
+
+    try:
+        for command, pt in subs:
+            if jobs is not None and len(running) >= jobs:
+                finish(running.pop(0))
+            temps, commands = subpipe([command], subjobs=jobs)
+            running.append(([], temps))
+            with open(pt, 'wb') as f:
+                running[-1][0].extend(_spawn_pipeline(commands, None, f))
+    finally:
+        for sub in running:
+            finish(sub)
+
+
+def subpipe(commands, fdsub=False, subjobs=None):
     '''
     parses special syntax in pipe expressions
 
     | $(some command) executes to a temporary file whose path is inserted in
     | the command.
     | $((expression)) evaluates a arithmetic expression in place +-*/()
+
+    all $(some command) in the pipeline (which may contain further
+    substitutions) run in parallel, at most subjobs at a time if given.
+
+    with fdsub=True, $(some command) is instead started immediately with its
+    stdout connected to a pipe that is inserted in the command as /dev/fd/N
+    (like bash process substitution). this streams concurrently with the
+    consuming command and avoids the temp file, but the consumer must read
+    the input sequentially (no seeking). the returned temps list then
+    contains _Substitution objects, pass to _clean_temps when done. subjobs
+    is ignored as all substitutions must run alongside the pipeline.
     '''
     temps = []
-    commands = flat_list([i.split("|") for i in commands])
-    for i, command in enumerate(commands):
-        if re.match(r'.*\$\(.+\).*', command):
-            subs = re.findall(r'\$\(.+\)', command)
-            for sub in subs:
-                if "$((" in sub:
-                    pt = sub[:]
-                    while "$((" in pt:
-                        si = pt.rfind("$((")
-                        op = 2
-                        sj = si+3
-                        for s in pt[sj:]:
-                            if op == 0:
-                                break
-                            if s == "(":
-                                op += 1
-                            if s == ")":
-                                op -= 1
-                            sj += 1
-                        try:
-                            exp = pt[si+1:sj]
-                            pt = pt[:si] + str(eval(exp, {}, {})) + pt[sj:]
-                        except Exception:
-                            click.echo("bad expression: {}".format(exp))
-                            raise click.Abort
+    subs = []
+    commands = flat_list([_split_pipes(i) for i in commands])
+    try:
+        for i, command in enumerate(commands):
+            command = _arith(command)
+            spans, _ = _scan_subs(command)
+            for si, sj in reversed(spans):
+                sub = command[si+2:sj-1]
+                if fdsub:
+                    temps.append(_fdsub(sub))
+                    pt = "/dev/fd/{}".format(temps[-1].fd)
                 else:
                     f, pt = tempfile.mkstemp(dir="./", prefix='clasp_tmp')
+                    os.close(f)
                     temps.append(pt)
-                    pipeline([sub.strip('$()')], outfile=pt)
-                commands[i] = command.replace(sub, pt)
+                    subs.append((sub, pt))
+                command = command[:si] + pt + command[sj:]
+            commands[i] = command
+        _run_subs(subs, subjobs)
+    except BaseException:
+        _clean_temps(temps)
+        raise
     return temps, commands
 
 
+def _pipe_stdin(inp, forceinpfile=False):
+    """resolve stdin for first process of pipeline
+
+    Returns
+    -------
+    stdin: file object, subprocess.PIPE or None
+    strin: bool
+        True if inp (if any) must be written to stdin by the caller
+    """
+    if hasattr(inp, 'read'):
+        return inp, False
+    elif forceinpfile and inp is not None:
+        return open(inp, 'r'), False
+    elif inp is not None:
+        return subprocess.PIPE, True
+    return None, True
+
+
+def _spawn_pipeline(commands, stdin, stdout, cwd=None, stderr=None,
+                    fds=()):
+    """start each command connecting stdout to stdin of the next
+
+    intermediate pipes are closed in the parent once handed to the next
+    process so upstream commands receive SIGPIPE if downstream exits early.
+    fds are the process substitution pipes from subpipe (see _subfds) that
+    commands may reference as /dev/fd/N.
+
+    Returns
+    -------
+    pops: list
+        Popen objects in pipeline order
+    """
+    pops = []
+    for i, command in enumerate(commands):
+        if i > 0:
+            stdin = pops[i-1].stdout
+        if i == len(commands) - 1:
+            out = stdout
+        else:
+            out = subprocess.PIPE
+        try:
+            pops.append(subprocess.Popen(shlex.split(command), stdin=stdin,
+                                         stdout=out, cwd=cwd, stderr=stderr,
+                                         pass_fds=_devfds(command, fds)))
+        except OSError:
+            for p in pops:
+                p.kill()
+                p.wait()
+            message = "invalid command / no such file: {}".format(command)
+            raise OSError(2, message)
+        if i > 0:
+            pops[i-1].stdout.close()
+    return pops
+
+
+def _encode(inp):
+    """encode str to bytes (other input returned as is)"""
+    try:
+        return inp.encode(encoding)
+    except AttributeError:
+        return inp
+
+
+def _feed(stdin, inp, chunksize=2**16):
+    """write inp to stdin in a background thread and close
+
+    bytes-like input is written straight from a memoryview in chunks (no
+    copies), partial writes are resumed.
+    """
+    view = memoryview(_encode(inp)).cast('B')
+
+    def write():
+        fd = stdin.fileno()
+        try:
+            i = 0
+            while i < len(view):
+                i += os.write(fd, view[i:i+chunksize])
+        except (BrokenPipeError, OSError, ValueError):
+            pass
+        finally:
+            try:
+                stdin.close()
+            except BrokenPipeError:
+                pass
+
+    feeder = threading.Thread(target=write, daemon=True)
+    feeder.start()
+    return feeder
+
+
+def _drain(fd, chunks):
+    """read fd to EOF into chunks in a background thread and close"""
+    def read():
+        with os.fdopen(fd, 'rb') as f:
+            chunks.append(f.read())
+
+    drainer = threading.Thread(target=read, daemon=True)
+    drainer.start()
+    return drainer
+
+
+def _exitcode(status):
+    """convert wait status to returncode (negative signal if killed)"""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _reap(p, stage, start):
+    """wait for process in a background thread, filling stage with
+    wall time, rusage and (on linux) io counters and setting returncode"""
+    def wait():
+        try:
+            os.waitid(os.P_PID, p.pid, os.WEXITED | os.WNOWAIT)
+            with open('/proc/{}/io'.format(p.pid), 'r') as f:
+                io = dict(i.split(":") for i in f.read().splitlines())
+            stage['rchar'] = int(io['rchar'])
+            stage['wchar'] = int(io['wchar'])
+        except (AttributeError, OSError, KeyError, ValueError):
+            pass
+        pid, status, ru = os.wait4(p.pid, 0)
+        stage['wall'] = time.perf_counter() - start
+        stage['utime'] = ru.ru_utime
+        stage['stime'] = ru.ru_stime
+        stage['maxrss'] = ru.ru_maxrss
+        stage['returncode'] = p.returncode = _exitcode(status)
+
+    reaper = threading.Thread(target=wait, daemon=True)
+    reaper.start()
+    return reaper
+
+
+class PipelineStats(object):
+    """timing and resource accounting of a pipeline call
+
+    Attributes
+    ----------
+    stages: list of dict
+        for each process: command, wall (seconds from start to exit),
+        utime and stime (cpu seconds), maxrss (as reported by getrusage,
+        KiB on linux, note this is never less than the size of the forked
+        python process before exec), returncode and on linux rchar/wchar
+        (bytes read and written by the process, including through the pipes)
+    subpipe: float
+        seconds spent running $(some command) substitutions
+    wall: float
+        total seconds for the pipeline call
+    bytes_in: int
+        bytes fed to stdin (if inp is a string or bytes)
+    bytes_out: int
+        bytes read from stdout (if not sent to outfile)
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.subpipe = 0.0
+        self.wall = 0.0
+        self.bytes_in = None
+        self.bytes_out = None
+
+    def slowest(self):
+        """stage with the largest wall time"""
+        return max(self.stages, key=lambda x: x.get('wall', 0))
+
+    def __str__(self):
+        lines = ["{:>8} {:>8} {:>8} {:>10} {:>4}  command".format(
+                 'wall', 'user', 'sys', 'maxrss', 'exit')]
+        for st in self.stages:
+            lines.append("{:8.3f} {:8.3f} {:8.3f} {:10} {:4}  {}".format(
+                st.get('wall', 0), st.get('utime', 0), st.get('stime', 0),
+                st.get('maxrss', 0), st.get('returncode'), st['command']))
+        lines.append("subpipe: {:.3f}s total: {:.3f}s in: {} out: {}".format(
+            self.subpipe, self.wall, self.bytes_in, self.bytes_out))
+        return "\n".join(lines)
+
+
+def _communicate(pops, inp=None, errfd=None, reapers=None):
+    """feed inp to first process while draining stdout of the last process
+    and stderr of all processes (shared pipe errfd) concurrently.
+    when reapers are given (see _reap) these are joined instead of waiting
+    on each process.
+
+    Returns
+    -------
+    out: bytes
+        stdout of last process (None if not a pipe)
+    err: bytes
+        stderr (None if errfd is None)
+    """
+    threads = []
+    errs = []
+    if inp is not None:
+        threads.append(_feed(pops[0].stdin, inp))
+    if errfd is not None:
+        threads.append(_drain(errfd, errs))
+    if pops[-1].stdout is not None:
+        out = pops[-1].stdout.read()
+        pops[-1].stdout.close()
+    else:
+        out = None
+    if reapers is None:
+        for p in pops:
+            p.wait()
+    else:
+        threads += reapers
+    for thread in threads:
+        thread.join()
+    if errfd is None:
+        return out, None
+    return out, b"".join(errs)
+
+
 def pipeline(commands, outfile=None, inp=None, close=False, cwd=None,
-             writemode='w', forceinpfile=False, caperr=False):
+             writemode='w', forceinpfile=False, caperr=False, fdsub=False,
+             subjobs=None, cache=None, stats=False):
     """
     executes pipeline of shell commands (given as list of strings)
 
@@ -212,63 +697,69 @@ def pipeline(commands, outfile=None, inp=None, close=False, cwd=None,
         passed to open() for outfile ('w', 'wb' for write or 'a' for append)
     forceinpfile: bool
         always treat inp as a file, if a string, open the path for reading
+    caperr: bool
+        also return stderr of all processes (as bytes)
+    fdsub: bool
+        stream $(some command) through a /dev/fd/N pipe instead of a
+        temporary file (see subpipe)
+    subjobs: int
+        maximum number of $(some command) to run at once (default all)
+    cache: PipelineCache
+        return stored results for identical calls instead of executing
+    stats: bool
+        also return a PipelineStats with per process timing and resource
+        use (always executes, cache is ignored)
 
     Returns
     -------
     out: str
         returns stdout of pipeline (will be None if outfile is given)
+        if caperr also returns stderr and if stats the PipelineStats:
+        (out, [err], [stats])
     """
-    temps, commands = subpipe(commands)
+    if stats:
+        stats = PipelineStats()
+        start = time.perf_counter()
+    elif cache is not None:
+        return cache.pipeline(commands, outfile, inp, close, cwd, writemode,
+                              forceinpfile, caperr, fdsub=fdsub,
+                              subjobs=subjobs)
+    temps, commands = subpipe(commands, fdsub, subjobs)
+    if stats:
+        stats.subpipe = time.perf_counter() - start
     if caperr:
-        f, pt = tempfile.mkstemp(dir="./", prefix='clasp_tmp')
-        stderr = open(pt, 'wb')
+        errfd, stderr = os.pipe()
     else:
-        pt = None
-        stderr = None
-    pops = [0]*len(commands)
+        errfd = stderr = None
     if outfile is not None and not hasattr(outfile, 'read'):
         if cwd is not None:
             outfile = open(cwd + "/" + outfile, writemode)
         else:
             outfile = open(outfile, writemode)
-    for i in range(len(commands)):
-        if i == 0:
-            if hasattr(inp, 'read'):
-                strin = False
-                stdin = inp
-            elif forceinpfile and inp is not None:
-                strin = False
-                stdin = open(inp, 'r')
-            elif inp is not None:
-                strin = True
-                stdin = subprocess.PIPE
-            else:
-                strin = True
-                stdin = None
-        else:
-            stdin = pops[i-1].stdout
-        if i == len(commands) - 1 and outfile is not None:
-            stdout = outfile
-        else:
-            stdout = subprocess.PIPE
-        try:
-            pops[i] = subprocess.Popen(shlex.split(commands[i]),
-                                       stdin=stdin, stdout=stdout, cwd=cwd,
-                                       stderr=stderr)
-        except OSError:
-            message = "invalid command / no such file: {}".format(commands[i])
-            raise OSError(2, message)
+    stdin, strin = _pipe_stdin(inp, forceinpfile)
+    if outfile is not None:
+        stdout = outfile
+    else:
+        stdout = subprocess.PIPE
     try:
-        inp = inp.encode(encoding)
-    except Exception as e:
-        pass
-    if len(commands) == 1 and strin:
-        out = pops[0].communicate(inp)
+        pops = _spawn_pipeline(commands, stdin, stdout, cwd=cwd,
+                               stderr=stderr, fds=_subfds(temps))
+    except OSError:
+        if caperr:
+            os.close(errfd)
+        raise
+    finally:
+        _release_fds(temps)
+        if caperr:
+            os.close(stderr)
+    if not strin:
+        inp = None
+    if stats:
+        stats.stages = [dict(command=c) for c in commands]
+        reapers = [_reap(p, st, start) for p, st in zip(pops, stats.stages)]
     else:
-        if inp is not None and strin:
-            pops[0].stdin.write(inp)
-            pops[0].stdin.close()
-        out = pops[-1].communicate()
+        reapers = None
+    out = _communicate(pops, inp, errfd, reapers)
     try:
         output = out[0].decode(encoding)
     except Exception:
@@ -276,19 +767,537 @@ def pipeline(commands, outfile=None, inp=None, close=False, cwd=None,
         pass
     if close:
         outfile.close()
-    for temp in temps:
-        os.remove(temp)
+    _clean_temps(temps)
+    result = (output,)
+    if caperr:
+        result += (out[1],)
+    if stats:
+        stats.wall = time.perf_counter() - start
+        if inp is not None:
+            stats.bytes_in = len(memoryview(_encode(inp)).cast('B'))
+        if out[0] is not None:
+            stats.bytes_out = len(out[0])
+        result += (stats,)
+    if len(result) == 1:
+        return output
+    return result
+
+
+class PipelineCache(object):
+    """content addressed on-disk cache of pipeline results
+
+    entries are keyed by the pipeline commands (after $((expression))
+    expansion), cwd, the stdin contents and optionally the state of any file
+    named in the commands. the least recently used entries are removed once
+    the cache exceeds maxsize. entries are written atomically and eviction
+    and statistics are guarded by a lock file, so one cache directory can be
+    shared by concurrent pool_call workers.
+
+    note that exit status is not checked, a failed pipeline is cached like
+    any other result.
+
+    Parameters
+    ----------
+    path: str
+        cache directory (created if necessary)
+    maxsize: int
+        maximum total size of entries in bytes
+    hashfiles: bool or str
+        include files named in the commands in the key. True or 'mtime' uses
+        modification time and size, 'content' hashes the file contents.
+    """
+
+    def __init__(self, path="clasp_cache", maxsize=2**30, hashfiles=False):
+        self.path = os.path.abspath(path)
+        self.maxsize = maxsize
+        if hashfiles is True:
+            hashfiles = 'mtime'
+        self.hashfiles = hashfiles
+        os.makedirs(self.path, exist_ok=True)
+
+    @contextlib.contextmanager
+    def _lock(self):
+        with open(os.path.join(self.path, '.lock'), 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _update_stats(self, **kwargs):
+        with self._lock():
+            stats = self.stats()
+            for k, v in kwargs.items():
+                stats[k] = stats.get(k, 0) + v
+            with open(os.path.join(self.path, '.stats'), 'w') as f:
+                json.dump(stats, f)
+        return stats
+
+    def stats(self):
+        """hits, misses, evictions and size (approximate) of the cache"""
+        try:
+            with open(os.path.join(self.path, '.stats'), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict(hits=0, misses=0, evictions=0, size=0)
+
+    def _files(self, commands, cwd):
+        """state of files named in commands"""
+        state = []
+        for command in commands:
+            command = re.sub(r'[$()|]', ' ', command)
+            try:
+                tokens = shlex.split(command)
+            except ValueError:
+                tokens = command.split()
+            for token in tokens:
+                path = os.path.join(cwd or ".", token)
+                if not os.path.isfile(path):
+                    continue
+                if self.hashfiles == 'content':
+                    with open(path, 'rb') as f:
+                        state.append((token, hashlib.sha256(
+                            f.read()).hexdigest()))
+                else:
+                    st = os.stat(path)
+                    state.append((token, st.st_mtime_ns, st.st_size))
+        return state
+
+    def key(self, commands, inp=None, cwd=None, forceinpfile=False,
+            caperr=False):
+        """hash identifying a pipeline call (None if inp is a file object)"""
+        if hasattr(inp, 'read'):
+            return None
+        commands = [_arith(i) for i in
+                    flat_list([_split_pipes(j) for j in commands])]
+        h = hashlib.sha256(repr((commands, cwd, caperr)).encode('utf-8'))
+        if forceinpfile and inp is not None:
+            with open(inp, 'rb') as f:
+                h.update(f.read())
+        elif inp is not None:
+            h.update(_encode(inp))
+        if self.hashfiles:
+            h.update(repr(self._files(commands, cwd)).encode('utf-8'))
+        return h.hexdigest()
+
+    def get(self, key):
+        """return cached value or None (marks entry as recently used)"""
+        entry = os.path.join(self.path, key)
+        try:
+            with open(entry, 'rb') as f:
+                value = pickle.load(f)
+            os.utime(entry)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self._update_stats(misses=1)
+            return None
+        self._update_stats(hits=1)
+        return value
+
+    def put(self, key, value):
+        """store value and evict least recently used entries if needed"""
+        f, pt = tempfile.mkstemp(dir=self.path, prefix='.clasp_tmp')
+        with os.fdopen(f, 'wb') as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        size = os.path.getsize(pt)
+        os.replace(pt, os.path.join(self.path, key))
+        if self._update_stats(size=size)['size'] > self.maxsize:
+            self.evict()
+
+    def evict(self):
+        """remove least recently used entries until under maxsize"""
+        with self._lock():
+            entries = []
+            for entry in os.scandir(self.path):
+                if entry.name[0] != "." and entry.is_file():
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+            entries.sort()
+            size = sum(i[1] for i in entries)
+            evictions = 0
+            while entries and size > self.maxsize:
+                _, esize, path = entries.pop(0)
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                size -= esize
+                evictions += 1
+            stats = self.stats()
+            stats.update(size=size,
+                         evictions=stats.get('evictions', 0) + evictions)
+            with open(os.path.join(self.path, '.stats'), 'w') as f:
+                json.dump(stats, f)
+
+    def clear(self):
+        """remove all entries and reset statistics"""
+        with self._lock():
+            for entry in os.scandir(self.path):
+                if entry.name != ".lock":
+                    os.remove(entry.path)
+
+    def pipeline(self, commands, outfile=None, inp=None, close=False,
+                 cwd=None, writemode='w', forceinpfile=False, caperr=False,
+                 **kwargs):
+        """pipeline returning cached stdout (or writing it to outfile)"""
+        key = self.key(commands, inp, cwd, forceinpfile, caperr)
+        if key is None:
+            return pipeline(commands, outfile, inp, close, cwd, writemode,
+                            forceinpfile, caperr, **kwargs)
+        value = self.get(key)
+        if value is None:
+            value = pipeline(commands, None, inp, False, cwd, writemode,
+                             forceinpfile, caperr, **kwargs)
+            self.put(key, value)
+        if caperr:
+            output, err = value
+        else:
+            output = value
+        if outfile is not None:
+            if not hasattr(outfile, 'read'):
+                close = True
+                if cwd is not None:
+                    outfile = open(cwd + "/" + outfile, writemode)
+                else:
+                    outfile = open(outfile, writemode)
+            if 'b' in getattr(outfile, 'mode', 'w'):
+                outfile.write(_encode(output))
+            elif isinstance(output, bytes):
+                outfile.flush()
+                outfile.buffer.write(output)
+            else:
+                outfile.write(output)
+            outfile.flush()
+            if close:
+                outfile.close()
+            output = None
+        if caperr:
+            return output, err
+        return output
+
+
+def pipeline_iter(commands, inp=None, cwd=None, forceinpfile=False,
+                  binary=False, chunksize=65536, check=False, fdsub=False,
+                  subjobs=None):
+    """
+    executes pipeline of shell commands yielding stdout as it is produced
+
+    unlike pipeline, output is never buffered in full, so this is suitable
+    for very large outputs. supports the same special syntax as pipeline.
+    temporary files and processes are cleaned up when the generator is
+    exhausted or closed (processes are killed if closed early).
+
+    Parameters
+    ----------
+    commands: list
+        list of commands to execute in order
+    inp: str or filebuffer
+        string to feed to stdin at start of pipeline
+    cwd: str
+        directory to execute pipeline (Popen cwd)
+    forceinpfile: bool
+        always treat inp as a file, if a string, open the path for reading
+    binary: bool
+        yield raw chunks of bytes (at most chunksize) instead of decoded lines
+    chunksize: int
+        maximum size of chunks when binary=True
+    check: bool
+        raise subprocess.CalledProcessError if any process exits non-zero
+    fdsub: bool
+        stream $(some command) through a /dev/fd/N pipe instead of a
+        temporary file (see subpipe)
+    subjobs: int
+        maximum number of $(some command) to run at once (default all)
+
+    Yields
+    ------
+    out: str or bytes
+        lines of stdout (including line ending) or chunks of bytes
+
+    Returns
+    -------
+    returncodes: list
+        exit status of each process (value of StopIteration when the
+        generator finishes, accessible with `yield from`)
+    """
+    temps, commands = subpipe(commands, fdsub, subjobs)
+    stdin, strin = _pipe_stdin(inp, forceinpfile)
+    pops = []
+    text = None
+    finished = False
+    try:
+        try:
+            pops = _spawn_pipeline(commands, stdin, subprocess.PIPE, cwd=cwd,
+                                   fds=_subfds(temps))
+        finally:
+            _release_fds(temps)
+        if inp is not None and strin:
+            _feed(pops[0].stdin, inp)
+        out = pops[-1].stdout
+        if binary:
+            for chunk in iter(lambda: out.read1(chunksize), b''):
+                yield chunk
+        else:
+            text = io.TextIOWrapper(out, encoding=encoding, newline='')
+            for line in text:
+                yield line
+        finished = True
+    finally:
+        if text is not None:
+            text.close()
+        for p in pops:
+            if not finished and p.poll() is None:
+                p.kill()
+            if p.stdout is not None:
+                p.stdout.close()
+            p.wait()
+        if forceinpfile and not hasattr(inp, 'read') and inp is not None:
+            stdin.close()
+        _clean_temps(temps)
+    returncodes = [p.returncode for p in pops]
+    if check:
+        for p, command in zip(pops, commands):
+            if p.returncode != 0:
+                raise subprocess.CalledProcessError(p.returncode, command)
+    return returncodes
+
+
+async def apipeline(commands, outfile=None, inp=None, close=False, cwd=None,
+                    writemode='w', forceinpfile=False, caperr=False,
+                    fdsub=False, subjobs=None, sem=None):
+    """
+    asyncio version of pipeline (a coroutine)
+
+    stages are connected with os pipes and supervised by the running event
+    loop, so many pipelines can be awaited concurrently from one thread.
+    see apipeline_gather to run a batch with a concurrency limit.
+
+    Parameters
+    ----------
+    commands: list
+        list of commands to execute in order
+    outfile: writeable file object
+        optional destination for stdout
+    inp: str or filebuffer
+        string to feed to stdin at start of pipeline
+    close: bool
+        if true closes file object before returning
+    cwd: str
+        directory to execute pipeline (temp files and Popen cwd)
+    writemode: str
+        passed to open() for outfile ('w', 'wb' for write or 'a' for append)
+    forceinpfile: bool
+        always treat inp as a file, if a string, open the path for reading
+    caperr: bool
+        also return stderr of all processes (as bytes)
+    fdsub: bool
+        stream $(some command) through a /dev/fd/N pipe instead of a
+        temporary file (see subpipe)
+    subjobs: int
+        maximum number of $(some command) to run at once (default all)
+    sem: asyncio.Semaphore
+        optional semaphore to acquire while the pipeline runs
+
+    Returns
+    -------
+    out: str
+        returns stdout of pipeline (will be None if outfile is given)
+    """
+    if sem is not None:
+        async with sem:
+            return await apipeline(commands, outfile, inp, close, cwd,
+                                   writemode, forceinpfile, caperr, fdsub,
+                                   subjobs)
+    if "$(" in "".join(commands):
+        loop = asyncio.get_event_loop()
+        temps, commands = await loop.run_in_executor(None, subpipe, commands,
+                                                     fdsub, subjobs)
+    else:
+        temps, commands = subpipe(commands)
+    if outfile is not None and not hasattr(outfile, 'read'):
+        if cwd is not None:
+            outfile = open(cwd + "/" + outfile, writemode)
+        else:
+            outfile = open(outfile, writemode)
+    first, strin = _pipe_stdin(inp, forceinpfile)
+    stdin = first
     if caperr:
-        stderr.close()
-        err = open(pt, 'rb')
-        out1 = err.read()
-        err.close()
-        os.remove(pt)
-        return output, out1
+        stderr = asyncio.subprocess.PIPE
+    else:
+        stderr = None
+    pops = []
+    fds = _subfds(temps)
+    try:
+        for i, command in enumerate(commands):
+            if i < len(commands) - 1:
+                rfd, stdout = os.pipe()
+            elif outfile is not None:
+                stdout = outfile
+            else:
+                stdout = asyncio.subprocess.PIPE
+            try:
+                pops.append(await asyncio.create_subprocess_exec(
+                    *shlex.split(command), stdin=stdin, stdout=stdout,
+                    stderr=stderr, cwd=cwd, pass_fds=_devfds(command, fds)))
+            except OSError:
+                if i < len(commands) - 1:
+                    os.close(rfd)
+                message = "invalid command / no such file: {}".format(command)
+                raise OSError(2, message)
+            finally:
+                if i > 0:
+                    os.close(stdin)
+                if i < len(commands) - 1:
+                    os.close(stdout)
+                    stdin = rfd
+        _release_fds(temps)
+
+        async def feed():
+            if inp is not None and strin:
+                try:
+                    pops[0].stdin.write(_encode(inp))
+                    await pops[0].stdin.drain()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                pops[0].stdin.close()
+
+        async def read(stream):
+            if stream is None:
+                return None
+            return await stream.read()
+
+        out = await asyncio.gather(feed(), read(pops[-1].stdout),
+                                   *[read(p.stderr) for p in pops])
+        for p in pops:
+            await p.wait()
+    finally:
+        for p in pops:
+            if p.returncode is None:
+                p.kill()
+                await p.wait()
+        if forceinpfile and not hasattr(inp, 'read') and inp is not None:
+            first.close()
+        _release_fds(temps)
+        _clean_temps(temps)
+    try:
+        output = out[1].decode(encoding)
+    except Exception:
+        output = out[1]
+    if close:
+        outfile.close()
+    if caperr:
+        return output, b"".join(out[2:])
     else:
         return output
 
 
+async def apipeline_gather(commandsets, limit=None, **kwargs):
+    """
+    run many pipelines concurrently with apipeline (a coroutine)
+
+    Parameters
+    ----------
+    commandsets: list of lists
+        each item is a list of commands passed to apipeline
+    limit: int
+        maximum number of pipelines running at once (defaults to cpu count)
+    kwargs:
+        optional arguments for apipeline (shared by all pipelines)
+
+    Returns
+    -------
+    list of results in order of commandsets
+    """
+    if limit is None:
+        limit = os.cpu_count()
+    sem = asyncio.Semaphore(limit)
+    tokens = _RunnerTokens()
+    return await asyncio.gather(*[_budget_pipeline(c, sem, tokens, kwargs)
+                                  for c in commandsets])
+
+
+async def _budget_pipeline(commands, sem, tokens, kwargs):
+    """apipeline holding sem and a task from the process-wide budget"""
+    async with sem:
+        while not tokens.start():
+            await asyncio.sleep(tokens.budget.poll)
+        try:
+            return await apipeline(commands, **kwargs)
+        finally:
+            tokens.finish()
+
+
+def pipeline_batch(commandsets, jobs=None, order=True, **kwargs):
+    """
+    run many pipelines in parallel directly as child processes
+
+    like GNU parallel, keeps at most jobs pipelines in flight, starting the
+    next as soon as one finishes. the processes are supervised by a private
+    event loop (see apipeline) so no python worker processes are involved.
+    pipelines beyond the first also need a token from the process-wide
+    budget (see JobBudget, set_jobs).
+
+    Parameters
+    ----------
+    commandsets: list of lists
+        each item is a list of commands passed to apipeline
+    jobs: int
+        maximum number of pipelines running at once (defaults to cpu count)
+    order: bool
+        if True return list of results in order of commandsets, else return
+        a generator yielding (index, result) as each pipeline finishes
+    kwargs:
+        optional arguments for apipeline (shared by all pipelines)
+
+    Returns
+    -------
+    list of results (or generator of (index, result) if order=False)
+    """
+    if not order:
+        return _batch_iter(commandsets, jobs, kwargs)
+    # if a pipeline fails _batch_iter cancels the others (killing their
+    # processes) before the loop closes
+    results = {}
+    for i, result in _batch_iter(commandsets, jobs, kwargs):
+        results[i] = result
+    return [results[i] for i in range(len(results))]
+
+
+def _batch_iter(commandsets, jobs, kwargs):
+    """generator for pipeline_batch with order=False"""
+    if jobs is None:
+        jobs = os.cpu_count()
+    loop = asyncio.new_event_loop()
+    pending = set()
+
+    async def semaphore():
+        return asyncio.Semaphore(jobs)
+
+    try:
+        sem = loop.run_until_complete(semaphore())
+
+        tokens = _RunnerTokens()
+
+        async def run(i, commands):
+            return i, await _budget_pipeline(commands, sem, tokens, kwargs)
+
+        pending = {loop.create_task(run(i, c))
+                   for i, c in enumerate(commandsets)}
+        while pending:
+            done, pending = loop.run_until_complete(
+                asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED))
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.gather(*pending,
+                                                   return_exceptions=True))
+        loop.close()
+
+
 def flat_list(l):
     """flattens any depth list"""
     a = []
@@ -303,11 +1312,1030 @@ def flat_list(l):
     return a
 
 
+class JobBudget(object):
+    """process-wide limit on the number of tasks running at once
+
+    pool_call, pool_imap and pipeline_batch draw a token from the budget
+    for each task (or chunk) they run beyond their first one, which like
+    the implicit token of a make job needs none (so nested calls cannot
+    deadlock). a budget of jobs has jobs - 1 tokens, a make jobserver
+    provides tokens shared with the other jobs of the build.
+
+    Parameters
+    ----------
+    jobs: int
+        maximum number of tasks at once (None for no limit)
+    jobserver: tuple or str
+        (read fd, write fd) of a GNU make jobserver pipe or the path of its
+        fifo (overrides jobs)
+    """
+
+    #: seconds batch pipeline runners wait between attempts to get a token
+    poll = 0.01
+
+    def __init__(self, jobs=None, jobserver=None):
+        self.jobs = jobs
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._held = 0
+        self._tokens = []
+        self._reader = self._writer = None
+        self._select = False
+        # descriptors opened here (not the ones inherited from make)
+        self._opened = []
+        if isinstance(jobserver, str):
+            self._reader = os.open(jobserver, os.O_RDONLY | os.O_NONBLOCK)
+            self._writer = os.open(jobserver, os.O_WRONLY)
+            self._opened = [self._reader, self._writer]
+        elif jobserver is not None:
+            # reopen so O_NONBLOCK does not change the pipe make and other
+            # jobs read from
+            try:
+                self._reader = os.open('/proc/self/fd/{}'.format(jobserver[0]),
+                                       os.O_RDONLY | os.O_NONBLOCK)
+                self._opened = [self._reader]
+            except OSError:
+                self._reader = jobserver[0]
+                self._select = True
+            self._writer = jobserver[1]
+
+    @property
+    def jobserver(self):
+        """True if tokens come from a make jobserver"""
+        return self._reader is not None
+
+    def acquire(self):
+        """take a token without waiting, return False if none is free"""
+        with self._lock:
+            if self._reader is not None:
+                if self._select:
+                    if not select.select([self._reader], [], [], 0)[0]:
+                        return False
+                try:
+                    token = os.read(self._reader, 1)
+                except (BlockingIOError, InterruptedError):
+                    return False
+                if not token:
+                    return False
+                self._tokens.append(token)
+            elif self.jobs is not None and self._held >= self.jobs - 1:
+                return False
+            self._held += 1
+            return True
+
+    def release(self):
+        """return a token"""
+        with self._lock:
+            if self._tokens:
+                os.write(self._writer, self._tokens.pop())
+            self._held -= 1
+
+    def close(self):
+        """return held jobserver tokens and close the descriptors opened by
+        the budget, it no longer limits tasks"""
+        with self._lock:
+            while self._tokens:
+                os.write(self._writer, self._tokens.pop())
+            for fd in self._opened:
+                os.close(fd)
+            self._opened = []
+            self._reader = self._writer = None
+            self.jobs = None
+
+
+class _RunnerTokens(object):
+    """tokens from the budget held by one pool_imap or pipeline_batch call,
+    its first running task needs none"""
+
+    def __init__(self):
+        self.budget = get_budget()
+        self.running = 0
+
+    def start(self):
+        """count a task as running if it may start now"""
+        if self.running and not self.budget.acquire():
+            return False
+        self.running += 1
+        return True
+
+    def finish(self):
+        self.running -= 1
+        if self.running:
+            self.budget.release()
+
+
+def _makeflags_jobserver(makeflags):
+    """return jobserver fds or fifo path from MAKEFLAGS (None if there is
+    no usable jobserver)"""
+    auth = re.findall(r"--jobserver-(?:auth|fds)=(\S+)", makeflags)
+    if not auth:
+        return None
+    if auth[-1].startswith('fifo:'):
+        path = auth[-1][5:]
+        if os.path.exists(path):
+            return path
+        return None
+    try:
+        fds = tuple(int(i) for i in auth[-1].split(','))
+        for fd in fds:
+            os.fstat(fd)
+    except (ValueError, OSError):
+        # make did not pass the fds (recipe not marked recursive with +)
+        return None
+    if len(fds) != 2 or min(fds) < 0:
+        return None
+    return fds
+
+
+_budget = None
+
+
+def get_budget():
+    """return the process-wide JobBudget
+
+    created on first use (and in each new worker process), joining the GNU
+    make jobserver of MAKEFLAGS if clasp runs under make -j, else without
+    limit unless set with set_jobs.
+    """
+    global _budget
+    if _budget is None or _budget.pid != os.getpid():
+        _budget = JobBudget(jobserver=_makeflags_jobserver(
+            os.environ.get('MAKEFLAGS', '')))
+    return _budget
+
+
+def set_jobs(jobs=None):
+    """set the process-wide limit on tasks running at once (see JobBudget)
+
+    Parameters
+    ----------
+    jobs: int
+        maximum number of tasks run at once by all pool_call, pool_imap and
+        pipeline_batch calls together. if None join the jobserver of a
+        parent make if any, else do not limit.
+    """
+    global _budget
+    if _budget is not None and _budget.pid == os.getpid():
+        _budget.close()
+    if jobs is None:
+        _budget = None
+        get_budget()
+    else:
+        _budget = JobBudget(jobs)
+
+
+#: shared executors by backend {backend: (executor, max_workers, init, pid)}
+_pools = {}
+
+_worker_state = None
+
+#: state of the current thread, task is True while it runs a pool task
+_local = threading.local()
+
+#: executor classes available as pool_call backends
+backends = dict(process=ProcessPoolExecutor, thread=ThreadPoolExecutor)
+
+
+def _init_worker(initializer, initargs):
+    """run initializer storing its return value for worker_state"""
+    global _worker_state
+    _worker_state = initializer(*initargs)
+
+
+def worker_state():
+    """return value of the pool initializer in the current worker
+
+    use inside functions executed by pool_call to access state loaded once
+    per worker (see pool_call initializer)::
+
+        def task(hour):
+            weather = worker_state()
+            ...
+
+        pool_call(task, hours, initializer=read_epw, initargs=(epwfile,))
+    """
+    return _worker_state
+
+
+def _task(fn, *args):
+    """call fn(*args) flagging the thread as running a pool task (executed
+    in worker)"""
+    outer = _in_task()
+    _local.task = True
+    try:
+        return fn(*args)
+    finally:
+        _local.task = outer
+
+
+def _in_task():
+    """check if the current thread runs a task of pool_call or pool_imap"""
+    return getattr(_local, 'task', False)
+
+
+def _same_init(init, initializer, initargs):
+    """check if pool was initialized with initializer(*initargs)"""
+    if init is None or init[0] is not initializer:
+        return False
+    try:
+        return bool(init[1] == tuple(initargs))
+    except Exception:
+        return init[1] is initargs
+
+
+def _shared_pool(backend):
+    """return the _pools entry of backend (None values if there is none),
+    dropping an entry inherited from the parent of a forked worker"""
+    entry = _pools.get(backend)
+    if entry is not None and entry[3] != os.getpid():
+        # the executor (and its workers) belong to the parent process
+        del _pools[backend]
+        entry = None
+    return entry or (None, None, None, None)
+
+
+def get_pool(max_workers=None, backend='process', initializer=None,
+             initargs=()):
+    """return the shared executor used by pool_call
+
+    the pool is created on first use and reused by later calls, so worker
+    startup is paid once per script. it is replaced if it is broken or a
+    different max_workers or initializer is requested, and shut down at
+    exit.
+
+    process workers keep the module globals (and any other state) of the
+    moment the pool started, a global the script changes afterwards is not
+    seen by later tasks, which silently compute with the old value. pass
+    such values as arguments, or scope the pool with worker_pool (or call
+    shutdown_pool after the change) so the next call starts fresh workers.
+
+    Parameters
+    ----------
+    max_workers: int
+        number of workers (defaults to the size of the current pool or cpu
+        count if there is none)
+    backend: str or concurrent.futures.Executor
+        'process' (ProcessPoolExecutor) or 'thread' (ThreadPoolExecutor).
+        an executor (such as cluster.ClusterExecutor) is returned as is, it
+        is managed (and its workers initialized) by the caller.
+    initializer: callable
+        called once per worker process (once in total for threads) with
+        initargs, the return value is available to tasks via worker_state.
+        if None the current pool is reused whatever its initializer.
+    initargs: tuple
+        arguments for initializer
+
+    Returns
+    -------
+    pool: concurrent.futures.Executor
+    """
+    if isinstance(backend, Executor):
+        return backend
+    pool, workers, init, _ = _shared_pool(backend)
+    if max_workers is None:
+        max_workers = workers or os.cpu_count()
+    if initializer is None:
+        newinit = False
+    else:
+        newinit = not _same_init(init, initializer, initargs)
+        init = (initializer, tuple(initargs))
+    if pool is not None and (workers != max_workers or newinit or
+                             getattr(pool, '_broken', False)):
+        shutdown_pool(backend=backend)
+        pool = None
+    if pool is None:
+        pool = _new_pool(max_workers, backend, init)
+        _pools[backend] = (pool, max_workers, init, os.getpid())
+    return pool
+
+
+def _new_pool(max_workers, backend, init):
+    """start an executor of backend running _init_worker(*init) in each
+    worker (if init is not None)"""
+    if backend == 'process' and shared_memory is not None:
+        # workers must share the parent's tracker or each starts its own
+        # that reports (and unlinks) shared memory segments at exit
+        resource_tracker.ensure_running()
+    if init is None:
+        return backends[backend](max_workers=max_workers)
+    if backend == 'thread':
+        _init_worker(*init)
+        return backends[backend](max_workers=max_workers)
+    return backends[backend](max_workers=max_workers,
+                             initializer=_init_worker, initargs=init)
+
+
+def _call_pool(max_workers, backend, initializer, initargs):
+    """return (executor, private) for pool_call and pool_imap
+
+    a call made inside a pool task gets a private executor, which the caller
+    shuts down when done: the workers of the shared pool may all be busy
+    with the calling tasks (threads) or belong to the parent process
+    (processes).
+    """
+    if not _in_task() or isinstance(backend, Executor):
+        return get_pool(max_workers, backend, initializer, initargs), False
+    if initializer is None:
+        init = None
+    else:
+        init = (initializer, tuple(initargs))
+    return _new_pool(max_workers or os.cpu_count(), backend, init), True
+
+
+def pool_size(backend='process'):
+    """number of workers of the shared pool (cpu count if not started)"""
+    if isinstance(backend, Executor):
+        return getattr(backend, '_max_workers', os.cpu_count())
+    return _shared_pool(backend)[1] or os.cpu_count()
+
+
+def shutdown_pool(wait=True, backend=None):
+    """shut down the shared pool of backend (or all if None), a new one is
+    created on next use"""
+    if backend is None:
+        for backend in list(_pools.keys()):
+            shutdown_pool(wait, backend)
+    elif _shared_pool(backend)[0] is not None:
+        _pools.pop(backend)[0].shutdown(wait=wait)
+
+
+atexit.register(shutdown_pool)
+
+
+@contextlib.contextmanager
+def worker_pool(max_workers=None, backend='process', initializer=None,
+                initargs=()):
+    """context manager scoping the shared pool, shutting it down on exit::
+
+        with worker_pool(4):
+            for i in sweeps:
+                pool_call(func, i)
+    """
+    try:
+        yield get_pool(max_workers, backend, initializer, initargs)
+    finally:
+        shutdown_pool(backend=backend)
+
+
+def _call(func, cwd, args, kwargs):
+    """call func in cwd (executed in worker process)"""
+    if cwd is not None:
+        os.chdir(cwd)
+    return func(*args, **kwargs)
+
+
+#: minimum size in bytes of buffer arguments (bytes, bytearray, memoryview,
+#: array.array, numpy.ndarray) that pool_call(shm=True) passes to worker
+#: processes through shared memory instead of pickling
+shm_threshold = 2**20
+
+#: memoryview formats that can be reconstructed in the worker
+_shm_formats = set("bBhHiIlLqQnNfd?c")
+
+#: shared memory segments attached in this (worker) process
+_attached = {}
+
+
+class _SharedArg(object):
+    """reference to a buffer argument placed in shared memory by pool_call
+
+    replaced in the worker by a read-only zero-copy view: a numpy.ndarray
+    for arrays, otherwise a memoryview (cast to the original format and
+    shape for array.array and memoryview).
+    """
+
+    def __init__(self, name, nbytes, fmt='B', shape=None, ndarray=False):
+        self.name = name
+        self.nbytes = nbytes
+        self.fmt = fmt
+        self.shape = shape
+        self.ndarray = ndarray
+
+    def view(self):
+        if self.name not in _attached:
+            try:
+                shm = shared_memory.SharedMemory(name=self.name, track=False)
+            except TypeError:
+                shm = shared_memory.SharedMemory(name=self.name)
+            _attached[self.name] = shm
+        buf = _attached[self.name].buf[:self.nbytes]
+        if self.ndarray:
+            view = np.ndarray(self.shape, self.fmt, buffer=buf)
+            view.flags.writeable = False
+            return view
+        if self.shape is not None:
+            buf = buf.cast(self.fmt, self.shape)
+        elif self.fmt != 'B':
+            buf = buf.cast(self.fmt)
+        return buf.toreadonly()
+
+
+class _SharedArgs(object):
+    """parent side bookkeeping of buffers shared with pool workers
+
+    identical objects are copied once and reference counted, segments are
+    unlinked when released by all tasks using them (or on close).
+    """
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.table = {}
+
+    def _create(self, obj):
+        if np is not None and isinstance(obj, np.ndarray):
+            if obj.dtype.hasobject or obj.nbytes < self.threshold:
+                return None
+            shm = shared_memory.SharedMemory(create=True, size=obj.nbytes)
+            np.ndarray(obj.shape, obj.dtype, buffer=shm.buf)[...] = obj
+            return shm, _SharedArg(shm.name, obj.nbytes, obj.dtype.str,
+                                   obj.shape, True)
+        if not isinstance(obj, (bytes, bytearray, memoryview, array.array)):
+            return None
+        view = memoryview(obj)
+        if (view.nbytes < self.threshold or not view.c_contiguous or
+                view.format not in _shm_formats):
+            return None
+        shm = shared_memory.SharedMemory(create=True, size=view.nbytes)
+        shm.buf[:view.nbytes] = view.cast('B')
+        shape = None
+        if view.ndim > 1:
+            shape = view.shape
+        return shm, _SharedArg(shm.name, view.nbytes, view.format, shape)
+
+    def share(self, obj, keys):
+        """return _SharedArg for large buffers (appending key) or obj"""
+        key = id(obj)
+        if key not in self.table:
+            created = self._create(obj)
+            if created is None:
+                return obj
+            self.table[key] = [obj, created[0], created[1], 0]
+        self.table[key][3] += 1
+        keys.append(key)
+        return self.table[key][2]
+
+    def share_args(self, arg, expand, keys):
+        if expand:
+            return tuple(self.share(i, keys) for i in arg)
+        return self.share(arg, keys)
+
+    def release(self, keys):
+        for key in keys:
+            entry = self.table[key]
+            entry[3] -= 1
+            if entry[3] == 0:
+                del self.table[key]
+                entry[1].close()
+                entry[1].unlink()
+
+    def close(self):
+        for entry in self.table.values():
+            entry[1].close()
+            entry[1].unlink()
+        self.table = {}
+
+
+def _resolve_shared(chunk, kwargs, expand):
+    """replace _SharedArg in chunk and kwargs by views and detach segments
+    no longer referenced (executed in worker process)"""
+    names = set()
+
+    def resolve(arg):
+        if isinstance(arg, _SharedArg):
+            names.add(arg.name)
+            return arg.view()
+        return arg
+
+    kwargs = {k: resolve(v) for k, v in kwargs.items()}
+    if expand:
+        chunk = [tuple(resolve(i) for i in arg) for arg in chunk]
+    else:
+        chunk = [resolve(arg) for arg in chunk]
+    _detach(names)
+    return chunk, kwargs
+
+
+def _detach(keep):
+    """close attached segments not in keep (those still exported by live
+    views stay attached)"""
+    for name in list(_attached.keys()):
+        if name not in keep:
+            try:
+                _attached[name].close()
+            except BufferError:
+                continue
+            del _attached[name]
+
+
+def _call_chunk(func, cwd, chunk, kwargs, expand):
+    """call func for each item of chunk in cwd (executed in worker process)
+
+    Returns
+    -------
+    results: list
+    elapsed: float
+        total seconds spent in func
+    """
+    if cwd is not None:
+        os.chdir(cwd)
+    if shared_memory is not None:
+        chunk, kwargs = _resolve_shared(chunk, kwargs, expand)
+    start = time.perf_counter()
+    if expand:
+        results = [func(*arg, **kwargs) for arg in chunk]
+    else:
+        results = [func(arg, **kwargs) for arg in chunk]
+    return results, time.perf_counter() - start
+
+
+class PoolCallError(Exception):
+    """tasks of pool_call or pool_imap failed permanently (after retries)
+
+    Attributes
+    ----------
+    failed: dict
+        {index: exception} for each failed task
+    results: list
+        results collected by pool_call (None for failed tasks)
+    """
+
+    def __init__(self, failed, results=None):
+        self.failed = failed
+        self.results = results
+        Exception.__init__(self, "{} task(s) failed: {}".format(
+            len(failed), sorted(failed)))
+
+
+#: target seconds of work per chunk for pool_imap(chunksize='auto')
+chunk_target = 0.05
+
+
+class CostModel(object):
+    """task durations learned per argument class for pool_imap(cost=...)
+
+    called with an arg it returns the mean duration measured for its class
+    in previous runs. unseen classes are estimated as the most expensive
+    known class so they are scheduled early (and measured).
+
+    Parameters
+    ----------
+    path: str
+        json file to load and save measurements (None keeps them in memory)
+    key: callable
+        maps an arg to its class (such as the -ab value of a rtrace
+        option string), defaults to the arg itself. classes are compared by
+        repr.
+    """
+
+    def __init__(self, path=None, key=None):
+        self.path = path
+        self.key = key
+        self.costs = {}
+        if path is not None and os.path.isfile(path):
+            with open(path) as f:
+                self.costs = json.load(f)
+
+    def classify(self, arg):
+        if self.key is not None:
+            arg = self.key(arg)
+        return repr(arg)
+
+    def __call__(self, arg):
+        try:
+            return self.costs[self.classify(arg)][1]
+        except KeyError:
+            return max([i[1] for i in self.costs.values()], default=1.0)
+
+    def update(self, arg, seconds):
+        """add a measured duration to the running mean of arg's class"""
+        c = self.classify(arg)
+        n, mean = self.costs.get(c, (0, 0.0))
+        self.costs[c] = (n + 1, mean + (seconds - mean) / (n + 1))
+
+    def save(self):
+        """write measurements to path"""
+        if self.path is None:
+            return
+        d = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=d)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.costs, f)
+        os.replace(tmp, self.path)
+
+
+def pool_imap(func, args, kwargs={}, cwd=None, order=True, expand=False,
+              max_workers=None, inflight=None, chunksize=1,
+              backend='process', initializer=None, initargs=(), retries=None,
+              journal=None, cost=None, shm=False):
+    """
+    generator executing func in the shared pool yielding results as they
+    complete
+
+    tasks are submitted lazily (args may be a generator) and at most
+    inflight tasks are pending or waiting to be yielded at any time, so
+    memory stays bounded for very large sweeps. the pool keeps working
+    while results are consumed. chunks beyond the first in flight also need
+    a token from the process-wide budget (see JobBudget, set_jobs), so
+    concurrent calls and a parent make -j share the cores. if a task raises
+    (or the generator is closed early) tasks not started yet are cancelled
+    and running ones are waited for before the exception is raised.
+
+    Parameters
+    ----------
+    func: python function
+        function to execute
+    args: iterable of tuples
+        each set is mapped to function
+    kwargs: dict
+        constant keyword args for func
+    cwd: str
+        directory in which to execute function calls
+    order: bool
+        if True yield results in order of input, else yield (index, result)
+        in order of completion
+    expand: bool
+        whether to expand items in args to map to function args
+    max_workers: int
+        number of workers (see get_pool)
+    inflight: int
+        maximum number of chunks submitted but not yet yielded (defaults to
+        twice the number of workers)
+    chunksize: int or 'auto'
+        number of args sent to a worker per submission. 'auto' starts with
+        single tasks and grows chunks so each takes about chunk_target
+        seconds (based on the measured duration of completed tasks)
+    backend: str or concurrent.futures.Executor
+        'process', 'thread' or an executor (see pool_call)
+    initializer: callable
+        run once per worker, access return value with worker_state
+    initargs: tuple
+        arguments for initializer
+    retries: int
+        if a worker dies (segfault, out of memory killer) the pool is rebuilt
+        and the tasks that were in flight are rerun one at a time to find the
+        culprit. a task is resubmitted up to retries times after breaking
+        the pool on its own, then it yields None (or nothing if order=False)
+        and PoolCallError is raised once all other tasks are done. if None,
+        BrokenProcessPool is raised immediately.
+    journal: str
+        path of an append-only file recording each result by task index and
+        argument hash. tasks already in the journal (same index, func, args
+        and kwargs) are not executed again, so an interrupted call can be
+        resumed by repeating it.
+    cost: sequence, callable or CostModel
+        estimated cost of each task (a value per arg, or a function of the
+        arg). tasks are submitted most expensive first so long tasks do not
+        end up in the tail of a sweep, results are still yielded in input
+        order if order=True. a CostModel is updated with measured durations
+        (and saved) as tasks complete. args are read into a list and
+        inflight only limits pending chunks, as results may need to wait for
+        a cheap task early in the input.
+    shm: bool
+        pass buffer arguments of at least shm_threshold bytes to process
+        workers through shared memory instead of pickling them (see
+        pool_call, this changes the type the task receives)
+
+    Yields
+    ------
+    result (or (index, result) if order=False)
+    """
+    if journal is not None:
+        yield from _journal_imap(journal, func, args, kwargs, order, dict(
+            cwd=cwd, expand=expand, max_workers=max_workers,
+            inflight=inflight, chunksize=chunksize, backend=backend,
+            initializer=initializer, initargs=initargs, retries=retries,
+            cost=cost, shm=shm))
+        return
+    executor, private = _call_pool(max_workers, backend, initializer,
+                                   initargs)
+    cwd = _pool_cwd(cwd, backend)
+    if inflight is None:
+        inflight = 2 * pool_size(executor)
+    auto = chunksize == 'auto'
+    if auto:
+        chunksize = 1
+        try:
+            maxchunk = max(1, len(args) // (4 * pool_size(executor)))
+        except TypeError:
+            maxchunk = 1024
+    if cost is None:
+        tasks = enumerate(args)
+    else:
+        args = list(args)
+        if callable(cost):
+            costs = [cost(arg) for arg in args]
+        else:
+            costs = list(cost)
+            if len(costs) != len(args):
+                raise ValueError("cost needs one value per arg")
+        tasks = iter(sorted(enumerate(args), key=lambda x: -costs[x[0]]))
+    model = cost if isinstance(cost, CostModel) else None
+    tokens = _RunnerTokens()
+    pending = {}
+    done = {}
+    ready = []
+    broken = []
+    retry = collections.deque()
+    attempts = {}
+    failed = {}
+    current = 0
+    ntasks = 0
+    elapsed = 0.0
+    if shm and backend == 'process' and shared_memory is not None:
+        shared = _SharedArgs(shm_threshold)
+        kwkeys = []
+        kwargs = {k: shared.share(v, kwkeys) for k, v in kwargs.items()}
+    else:
+        shared = None
+
+    def submit():
+        if not tokens.start():
+            return False
+        if retry:
+            chunk = [retry.popleft()]
+        else:
+            chunk = list(itertools.islice(tasks, chunksize))
+        if not chunk:
+            tokens.finish()
+            return False
+        keys = []
+        if shared is None:
+            chunkargs = [i[1] for i in chunk]
+        else:
+            chunkargs = [shared.share_args(i[1], expand, keys) for i in chunk]
+        future = executor.submit(_task, _call_chunk, func, cwd, chunkargs,
+                                 kwargs, expand)
+        pending[future] = (chunk, keys)
+        return True
+
+    def room():
+        if retry:
+            return not pending
+        if cost is not None:
+            return len(pending) < inflight
+        return len(pending) + len(done) / chunksize < inflight
+
+    def collect(future):
+        """move results of future to ready, False if the pool broke"""
+        nonlocal chunksize, ntasks, elapsed
+        chunk, keys = pending.pop(future)
+        tokens.finish()
+        if shared is not None:
+            shared.release(keys)
+        try:
+            results, t = future.result()
+        except BrokenProcessPool as ex:
+            if retries is None:
+                raise
+            broken.extend((i, arg, ex) for i, arg in chunk)
+            return False
+        if auto:
+            ntasks += len(chunk)
+            elapsed += t
+            chunksize = int(chunk_target * ntasks / max(elapsed, 1e-9))
+            chunksize = min(max(1, chunksize), maxchunk)
+        if model is not None:
+            for i, arg in chunk:
+                model.update(arg, t / len(chunk))
+        ready.extend(zip([i[0] for i in chunk], results))
+        return True
+
+    try:
+        while room() and submit():
+            pass
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            if not all([collect(future) for future in finished]):
+                for future in wait(pending)[0]:
+                    collect(future)
+                for i, arg, ex in broken:
+                    if len(broken) == 1:
+                        attempts[i] = attempts.get(i, 0) + 1
+                    if attempts.get(i, 0) > retries:
+                        failed[i] = ex
+                        if order:
+                            ready.append((i, None))
+                    else:
+                        retry.append((i, arg))
+                broken.clear()
+                if private:
+                    executor.shutdown(wait=False)
+                executor, private = _call_pool(max_workers, backend,
+                                               initializer, initargs)
+            for i, result in ready:
+                if order:
+                    done[i] = result
+                else:
+                    yield i, result
+            ready.clear()
+            while current in done:
+                yield done.pop(current)
+                current += 1
+            while room() and submit():
+                pass
+        if failed:
+            raise PoolCallError(failed)
+    finally:
+        for future in pending:
+            future.cancel()
+        # tasks that already started finish (holding their tokens) before
+        # the caller gets the exception, as with a pool of its own
+        wait(pending)
+        for future in pending:
+            tokens.finish()
+        if shared is not None:
+            shared.close()
+        if private:
+            executor.shutdown()
+        if model is not None:
+            model.save()
+
+
+def _read_journal(journal):
+    """load {index: (arghash, result)} from journal, truncating any
+    incomplete record at the end (from a crash while writing)"""
+    records = {}
+    try:
+        f = open(journal, 'r+b')
+    except FileNotFoundError:
+        return records
+    with f:
+        good = 0
+        while True:
+            try:
+                i, h, result = pickle.load(f)
+            except Exception:
+                break
+            records[i] = (h, result)
+            good = f.tell()
+        f.truncate(good)
+    return records
+
+
+def _journal_imap(journal, func, args, kwargs, order, imap):
+    """pool_imap recording results to and restoring them from journal"""
+    base = hashlib.sha1(pickle.dumps((getattr(func, '__module__', None),
+                                      getattr(func, '__qualname__', None),
+                                      kwargs), pickle.HIGHEST_PROTOCOL))
+    records = _read_journal(journal)
+    cached = {}
+    todo = []
+    for i, arg in enumerate(args):
+        h = base.copy()
+        h.update(pickle.dumps(arg, pickle.HIGHEST_PROTOCOL))
+        h = h.hexdigest()
+        if i in records and records[i][0] == h:
+            cached[i] = records[i][1]
+        else:
+            todo.append((i, h, arg))
+    if imap.get('cost') is not None and not callable(imap['cost']):
+        imap['cost'] = [imap['cost'][i[0]] for i in todo]
+    n = len(cached) + len(todo)
+    current = 0
+    failed = {}
+    if not order:
+        for i in sorted(cached):
+            yield i, cached.pop(i)
+    with open(journal, 'ab') as f:
+        try:
+            for j, result in pool_imap(func, (i[2] for i in todo), kwargs,
+                                       order=False, **imap):
+                i, h, _ = todo[j]
+                pickle.dump((i, h, result), f, pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                if not order:
+                    yield i, result
+                    continue
+                cached[i] = result
+                while current in cached:
+                    yield cached.pop(current)
+                    current += 1
+        except PoolCallError as ex:
+            failed = {todo[j][0]: e for j, e in ex.failed.items()}
+    if order:
+        while current < n:
+            yield cached.pop(current, None)
+            current += 1
+    if failed:
+        raise PoolCallError(failed)
+
+
+def _pool_cwd(cwd, backend):
+    """change to cwd and return the cwd for workers to change to
+
+    threads share the cwd of the process so only processes need to change.
+    pool processes persist between calls, so they are always sent the
+    current directory (as a fresh fork would inherit it). other executors
+    (such as cluster.ClusterExecutor) only change if cwd is given.
+    """
+    if cwd is not None:
+        os.chdir(cwd)
+    if backend == 'thread':
+        return None
+    if cwd is None and isinstance(backend, Executor):
+        return None
+    return os.getcwd()
+
+
+#: number of tasks pool_call(backend='auto') times inline before choosing
+auto_probe = 3
+#: cpu/wall time ratio below which 'auto' considers tasks waiting (threads)
+auto_cpu_ratio = 0.5
+#: estimated seconds to start a pool by backend, updated when 'auto' starts
+#: one
+pool_startup = dict(process=0.2, thread=0.002)
+#: estimated seconds of overhead per task submitted by backend
+pool_dispatch = dict(process=5e-4, thread=5e-5)
+
+
+def _pool_ready(backend, max_workers, initializer, initargs):
+    """check if get_pool would reuse the running pool"""
+    pool, workers, init, _ = _shared_pool(backend)
+    return (pool is not None and not getattr(pool, '_broken', False) and
+            max_workers in (None, workers) and
+            (initializer is None or _same_init(init, initializer, initargs)))
+
+
+def _auto_call(func, args, kwargs, cwd, order, expand, max_workers, imap):
+    """pool_call(backend='auto'), time the first tasks inline and run the
+    rest inline, on threads or on processes, whichever is expected to
+    finish first"""
+    args = list(args)
+    cwd = _pool_cwd(cwd, 'process')
+    if imap['initializer'] is not None:
+        _init_worker(imap['initializer'], imap['initargs'])
+    results = []
+    wall = cpu = 0.0
+    for arg in args[:max(1, auto_probe)]:
+        start = time.process_time()
+        result, t = _call_chunk(func, None, [arg], kwargs, expand)
+        cpu += time.process_time() - start
+        wall += t
+        results.extend(result)
+    k = len(results)
+    rest = args[k:]
+    if not rest:
+        return results
+    if cpu < auto_cpu_ratio * wall:
+        backend = 'thread'
+    else:
+        backend = 'process'
+    nested = _in_task()
+    ready = not nested and _pool_ready(backend, max_workers,
+                                       imap['initializer'], imap['initargs'])
+    serial = len(rest) * wall / k
+    workers = max_workers or pool_size(backend)
+    parallel = (serial / workers + len(rest) * pool_dispatch[backend] +
+                (0 if ready else pool_startup[backend]))
+    if serial <= parallel:
+        return results + _call_chunk(func, None, rest, kwargs, expand)[0]
+    if not ready and not nested:
+        start = time.perf_counter()
+        get_pool(max_workers, backend, imap['initializer'],
+                 imap['initargs']).submit(int).result()
+        pool_startup[backend] = time.perf_counter() - start
+    if imap.get('cost') is not None and not callable(imap['cost']):
+        imap['cost'] = list(imap['cost'])[k:]
+    try:
+        for result in pool_imap(func, rest, kwargs, cwd, order, expand,
+                                max_workers, backend=backend, **imap):
+            results.append(result if order else result[1])
+    except PoolCallError as ex:
+        ex.failed = {i + k: e for i, e in ex.failed.items()}
+        ex.results = results
+        raise
+    return results
+
+
+def _collected(results, order, failed={}):
+    """results of pool_call from (index, result) pairs, with None for failed
+    tasks if order"""
+    if order:
+        results = sorted(results + [(i, None) for i in failed],
+                         key=lambda x: x[0])
+    return [i[1] for i in results]
+
+
 def pool_call(func, args, kwargs={}, cwd=None, order=True, expand=False,
-              handle=False, test=False):
+              handle=False, test=False, max_workers=None, chunksize=1,
+              backend='process', initializer=None, initargs=(), retries=None,
+              journal=None, cost=None, shm=False):
     """
     execute func with concurrent.futures return output
 
+    uses the shared pool from get_pool (see worker_pool to scope it), a
+    pool_call made by a task runs on a private executor started and shut
+    down for the call. process workers persist between calls and do not see
+    globals changed after the pool started (see get_pool). the backends
+    share the same task api and ordering. the 'thread' backend avoids
+    process startup, pickling and memory overhead and is faster when func
+    mostly waits on subprocesses (such as pipeline) or otherwise releases
+    the GIL. the 'process' backend is needed when func does substantial work
+    in python (see benchmarks/bench_pool_backends.py). 'auto' runs the first
+    auto_probe tasks inline, then runs the rest inline if that is quicker
+    than starting or feeding a pool (small batches in a loop), else on
+    threads if the tasks used little cpu time, else on processes.
+
     Parameters
     ----------
     func: python function
@@ -324,40 +2352,230 @@ def pool_call(func, args, kwargs={}, cwd=None, order=True, expand=False,
         whether to expand items in args to map to function args
     handle: bool
         whether to return future objects or results
+    test: bool
+        execute serially in the current process
+    max_workers: int
+        number of workers (defaults to cpu count)
+    chunksize: int or 'auto'
+        number of args sent to a worker at once (see pool_imap), ignored if
+        handle=True
+    backend: str or concurrent.futures.Executor
+        'process', 'thread' or 'auto' ('auto' is 'process' if handle=True or
+        with a journal), or an executor such as cluster.ClusterExecutor to
+        distribute tasks to worker daemons on other machines
+    initializer: callable
+        called once per worker with initargs to load shared state (such as
+        read_epw or a config file) instead of passing it with every task.
+        tasks access the return value with worker_state()
+    initargs: tuple
+        arguments for initializer
+    retries: int
+        rebuild the pool and resubmit unfinished tasks up to retries times
+        per task if a worker process dies (see pool_imap). tasks that still
+        fail raise PoolCallError (with .results and .failed) after all other
+        tasks complete.
+    journal: str
+        checkpoint file, completed results are appended as they finish and
+        reused when the call is repeated (see pool_imap), ignored if
+        handle=True or test=True
+    cost: sequence, callable or CostModel
+        task cost estimates, submit the most expensive tasks first (see
+        pool_imap), ignored if handle=True or test=True
+    shm: bool
+        with the process backend, place buffer arguments (bytes, bytearray,
+        memoryview, array.array, numpy.ndarray in args or kwargs) of at least
+        shm_threshold bytes in shared memory instead of pickling them to each
+        worker. func then receives a read-only view in place of the object: a
+        numpy.ndarray for arrays, a memoryview (cast to the original format)
+        for the other types, so methods such as bytes.count are not
+        available and the buffer cannot be modified. ignored if handle=True
+        or test=True
+
     Returns
     -------
     list of results unless handle=True then returns iterable of futures
     """
-    if cwd is not None:
-        os.chdir(cwd)
     if test:
-        return [func(*arg, **kwargs) for arg in args]
-
-    with ProcessPoolExecutor() as executor:
-        if expand:
-            futures = [executor.submit(func, *arg, **kwargs) for arg in args]
+        if cwd is not None:
+            os.chdir(cwd)
+        if initializer is not None:
+            _init_worker(initializer, initargs)
+        return _call_chunk(func, None, args, kwargs, expand)[0]
+    if backend == 'auto':
+        if handle or journal is not None:
+            backend = 'process'
         else:
-            futures = [executor.submit(func, arg, **kwargs) for arg in args]
-    if order:
-        it = futures
-    else:
-        it = as_completed(futures)
-    if handle:
-        return it
+            return _auto_call(func, args, kwargs, cwd, order, expand,
+                              max_workers, dict(
+                                  chunksize=chunksize,
+                                  initializer=initializer, initargs=initargs,
+                                  retries=retries, cost=cost, shm=shm))
+    if not handle:
+        # collect in order of completion and sort after, as the list is
+        # built anyway an early slow task must not hold back submissions
+        results = []
+        try:
+            for result in pool_imap(func, args, kwargs, cwd, False, expand,
+                                    max_workers, chunksize=chunksize,
+                                    backend=backend, initializer=initializer,
+                                    initargs=initargs, retries=retries,
+                                    journal=journal, cost=cost, shm=shm):
+                results.append(result)
+        except PoolCallError as ex:
+            ex.results = _collected(results, order, ex.failed)
+            raise
+        return _collected(results, order)
+    executor, private = _call_pool(max_workers, backend, initializer,
+                                   initargs)
+    cwd = _pool_cwd(cwd, backend)
+    if expand:
+        futures = [executor.submit(_task, _call, func, cwd, arg, kwargs)
+                   for arg in args]
     else:
-        return [future.result() for future in it]
+        futures = [executor.submit(_task, _call, func, cwd, (arg,), kwargs)
+                   for arg in args]
+    if private:
+        # submitted tasks still run
+        executor.shutdown(wait=False)
+    if order:
+        return futures
+    return as_completed(futures)
 
 
 def cluster_call(func, args, kwargs={}, timeout=.1, cwd=None,
-                 debug=False):
-    '''for backwards compatibility only'''
+                 debug=False, backend='process'):
+    '''for backwards compatibility only (backend may be a
+    cluster.ClusterExecutor to run on worker daemons)'''
     args = zip(*args)
     largs = kwarg_match(func, kwargs)
     if 'debug' in kwargs:
         test = kwargs['debug'] or debug
     else:
         test = False or debug
-    return pool_call(func, args, kwargs=largs, cwd=cwd, order=True, expand=True, test=test)
+    return pool_call(func, args, kwargs=largs, cwd=cwd, order=True,
+                     expand=True, test=test, backend=backend)
+
+
+def _read_store(store, nparams):
+    """load {params: results} from a sweep store, truncating a line left
+    incomplete by a crash"""
+    cells = {}
+    try:
+        f = open(store, 'r+')
+    except FileNotFoundError:
+        return cells
+    with f:
+        good = 0
+        for line in iter(f.readline, ''):
+            if not line.endswith('\n'):
+                break
+            good = f.tell()
+            row = line.rstrip('\n').split('\t')
+            if line.startswith('#') or len(row) <= nparams:
+                continue
+            cells[tuple(row[:nparams])] = _decode_cell(row[nparams:])
+        f.truncate(good)
+    return cells
+
+
+def _encode_cell(result):
+    """result columns as written to a sweep store"""
+    if not isinstance(result, (list, tuple)):
+        result = [result]
+    return [str(i) for i in result]
+
+
+def _decode_cell(columns):
+    """result columns read from a sweep store"""
+    return [try_float(i) for i in columns]
+
+
+def sweep(func, params, store=None, followers=[], kwargs={}, names=None,
+          **poolargs):
+    """call func with every combo of params in the pool, skipping combos
+    with results in store
+
+    combos are generated lazily (see CrossRef) and streamed into pool_imap,
+    each result is appended to store as soon as it completes, so an
+    interrupted sweep or one extended with new parameter values only
+    computes the missing cells.
+
+    Parameters
+    ----------
+    func: python function
+        called as func(*combo, **kwargs) with args in order of params
+    params: list of lists
+        values of each argument
+    store: str
+        tab separated result file, one line per combo with the args
+        followed by the result written with str (a list or tuple as
+        several columns). cells are identified by the args as written
+        (str).
+    followers: list of tuples
+        (leader, follower) index pairs of params (see CrossRef)
+    kwargs: dict
+        constant keyword args for func
+    names: list
+        column names written as a header (starting with #) to a new store
+    poolargs:
+        optional arguments for pool_imap (such as backend, max_workers,
+        chunksize, cost or retries)
+
+    Returns
+    -------
+    list of results in order of CrossRef(params, followers). without a
+    store these are the values returned by func. with a store every result
+    (cached or computed) is converted to the list of its columns as read
+    back from the store, each a float if it parses as a number (so '007'
+    becomes 7.0) else a str, so results do not depend on which cells were
+    cached.
+    """
+    combos = CrossRef(params, followers)
+    nparams = len(combos.columns)
+
+    def call_args(combo):
+        args = [None] * nparams
+        for i, v in zip(combos.columns, combo):
+            args[i] = v
+        return args
+
+    cells = {}
+    if store is not None:
+        cells = _read_store(store, nparams)
+    results = [None] * len(combos)
+    index = []
+
+    def todo():
+        for i, combo in enumerate(combos):
+            args = call_args(combo)
+            key = tuple(str(v) for v in args)
+            if key in cells:
+                results[i] = cells[key]
+            else:
+                index.append(i)
+                yield args
+
+    f = None
+    if store is not None:
+        new = not os.path.isfile(store) or os.path.getsize(store) == 0
+        f = open(store, 'a')
+        if new and names is not None:
+            f.write("#" + "\t".join(str(i) for i in names) + "\n")
+    try:
+        for j, result in pool_imap(func, todo(), kwargs, expand=True,
+                                   order=False, **poolargs):
+            if f is None:
+                results[index[j]] = result
+                continue
+            columns = _encode_cell(result)
+            results[index[j]] = _decode_cell(columns)
+            row = [str(i) for i in call_args(combos[index[j]])] + columns
+            f.write("\t".join(row) + "\n")
+            f.flush()
+    finally:
+        if f is not None:
+            f.close()
+    return results
 
 
 def read_epw(epw):
@@ -437,6 +2655,40 @@ def coerce_data(datastr, i_vals, dataf, coerce=True):
     return data
 
 
+def _float_array(col):
+    """convert strings to a float array, non numbers as nan"""
+    try:
+        return np.array(col, dtype=float)
+    except ValueError:
+        return np.array([float(i) if isnum(i) else np.nan for i in col])
+
+
+def coerce_array(datastr, i_vals, dataf, coerce=True):
+    '''like coerce_data but return numpy arrays, converting each column at
+    once. if coerce non numbers are dropped, else kept as nan'''
+    if datastr == [['']]:
+        return [np.array([])]
+    data = []
+    for i in i_vals:
+        try:
+            col = [j[i] for j in datastr]
+        except Exception:
+            raise IndexError("list index out of range index: {} in file: {}"
+                             "".format(i, dataf))
+        a = _float_array(col)
+        if coerce:
+            # 'nan' in the file is a number, only mask failed conversions
+            bad = np.isnan(a)
+            if bad.any():
+                bad[bad] = [not isnum(col[k]) for k in np.flatnonzero(bad)]
+                a = a[~bad]
+        data.append(a)
+    if coerce and len(data) > 0 and len(data[0]) == 0:
+        raise ValueError("check if data file {} has xheaders {}"
+                         "".format(dataf, datastr))
+    return data
+
+
 def get_i(i, d_vals):
     """
     if (x, y) return y if x == i
@@ -477,7 +2729,8 @@ def read_data_file(dataf, header=False, xheader=False, comment="#",
 
 def read_data(dataf, x_vals=[0], y_vals=[-1], rows=False, header=False,
               weax=None, reverse=False, autox=None, comment="#", xheader=False,
-              delim="\t, ", coerce=True, weatherfile=False, drange=None):
+              delim="\t, ", coerce=True, weatherfile=False, drange=None,
+              as_array=False):
     """read generic csv/tsv data file
 
     Parameters
@@ -509,6 +2762,10 @@ def read_data(dataf, x_vals=[0], y_vals=[-1], rows=False, header=False,
         handles wea and epw file formates returning daylight parameters
     drange: list of ints
         limit series output to given indices.
+    as_array: Boolean
+        return each series as a numpy float array (see coerce_array), with
+        coerce=False non numbers are nan. returns lists if numpy is not
+        installed.
 
     Returns
     -------
@@ -520,32 +2777,69 @@ def read_data(dataf, x_vals=[0], y_vals=[-1], rows=False, header=False,
     head: list
         if header=True list of labels for each y_val else []
     """
+    loaded = _load_data(dataf, rows, header, reverse, comment, xheader, delim,
+                        coerce, weatherfile, drange)
+    return _extract_data(loaded, dataf, x_vals, y_vals, weax, autox, coerce,
+                         as_array)
+
+
+def _load_data(dataf, rows=False, header=False, reverse=False, comment="#",
+               xheader=False, delim="\t, ", coerce=True, weatherfile=False,
+               drange=None):
+    """parse dataf for _extract_data (see read_data)
+
+    Returns
+    -------
+    datastr: list
+        list of str values for each row (or column with rows=True)
+    labels: list
+        series labels
+    pick: Boolean
+        whether head is selected from labels by y_vals
+    """
     if weatherfile:
         datastr = [[str(i) for i in j] for j in read_epw(dataf)]
-        head = ['month', 'day', 'hour', 'direct normal', 'diffuse horizontal',
-                'global horizontal', 'sky cover']
-        head = [head[i] for i in y_vals]
+        labels = ['month', 'day', 'hour', 'direct normal',
+                  'diffuse horizontal', 'global horizontal', 'sky cover']
+        pick = True
     else:
         datastr = read_data_file(dataf, header, xheader, comment, delim,
                                  coerce=coerce)
+        pick = False
         if rows:
             if header:
-                head = datastr[0]
+                labels = datastr[0]
                 datastr = list(map(list, list(zip(*datastr[1:]))))
             else:
                 datastr = list(map(list, list(zip(*datastr))))
-                head = []
+                labels = []
         elif header:
-            head = [datastr[0][i] for i in y_vals]
+            labels = datastr[0]
+            pick = True
             datastr = datastr[1:]
         else:
-            head = []
+            labels = []
         if reverse:
             datastr.reverse()
     if drange is not None:
         datastr = [datastr[i] for i in drange]
+    return datastr, labels, pick
+
+
+def _extract_data(loaded, dataf, x_vals=[0], y_vals=[-1], weax=None,
+                  autox=None, coerce=True, as_array=False):
+    """select and coerce series from _load_data output (see read_data)"""
+    datastr, labels, pick = loaded
+    if pick:
+        head = [labels[i] for i in y_vals]
+    else:
+        head = labels
+    if as_array and np is not None:
+        coerce_f = coerce_array
+    else:
+        coerce_f = coerce_data
     if len(y_vals) > 0:
-        datay = coerce_data(datastr, y_vals, dataf, coerce)
+        datay = coerce_f(datastr, y_vals, dataf, coerce)
     else:
         datay = [[]]
     if autox is not None:
@@ -563,9 +2857,12 @@ def read_data(dataf, x_vals=[0], y_vals=[-1], rows=False, header=False,
         datax = [[daycount[int(i[0])-1] + i[1] for i in datax]]
     else:
         if len(x_vals) > 0:
-            datax = coerce_data(datastr, x_vals, dataf, coerce)
+            datax = coerce_f(datastr, x_vals, dataf, coerce)
         else:
             datax = [[]]
+    if as_array and np is not None:
+        datax = [np.asarray(i, dtype=float) for i in datax]
+        datay = [np.asarray(i, dtype=float) for i in datay]
     while len(datax) < len(datay) and len(datax) > 0:
         datax += [datax[-1]]
     if len(datax) > len(datay):
@@ -575,7 +2872,8 @@ def read_data(dataf, x_vals=[0], y_vals=[-1], rows=False, header=False,
 
 def read_all_data(datafs, x_vals=[], y_vals=[], **kwargs):
     """
-    read multiple data files and pair x and y data call read_data
+    read multiple data files and pair x and y data (as read_data, parsing
+    each file once)
 
     Parameters
     ----------
@@ -586,7 +2884,8 @@ def read_all_data(datafs, x_vals=[], y_vals=[], **kwargs):
     y_vals: list of ints or tuple int pairs
         (fileidx, colidx) or colidx to read from each file
     kwargs:
-        optional arguments for read_data
+        optional arguments for read_data (such as as_array=True to return
+        numpy arrays)
 
     Returns
     -------
@@ -605,22 +2904,36 @@ def read_all_data(datafs, x_vals=[], y_vals=[], **kwargs):
             x_vals = y_vals
     except Exception:
         pass
+    for k in kwargs:
+        if k not in arg_binder(read_data).args:
+            raise TypeError("read_data() got an unexpected keyword argument "
+                            "'{}'".format(k))
+    loadargs = kwarg_match(_load_data, kwargs)
+    extractargs = kwarg_match(_extract_data, kwargs)
+    # each file is parsed once and all its series are selected from it
+    loaded = {}
+
+    def series(d, x_vals, y_vals):
+        if d not in loaded:
+            loaded[d] = _load_data(d, **loadargs)
+        return _extract_data(loaded[d], d, x_vals, y_vals, **extractargs)
+
     for x in x_vals:
         if type(x) == tuple:
-            xd, _, _ = read_data(datafs[x[0]], [x[1]], [-1], **kwargs)
+            xd, _, _ = series(datafs[x[0]], [x[1]], [-1])
             xds += xd
         else:
             for d in datafs:
-                xd, _, _ = read_data(d, [x], [-1], **kwargs)
+                xd, _, _ = series(d, [x], [-1])
                 xds += xd
     for y in y_vals:
         if type(y) == tuple:
-            _, yd, label = read_data(datafs[y[0]], [], [y[1]], **kwargs)
+            _, yd, label = series(datafs[y[0]], [], [y[1]])
             yds += yd
             labels += label
         else:
             for d in datafs:
-                _, yd, label = read_data(d, [], [y], **kwargs)
+                _, yd, label = series(d, [], [y])
                 yds += yd
                 labels += label
     while len(xds) < len(yds) and len(xds) > 0:
@@ -665,7 +2978,7 @@ def expandpat(pat, s, mark=0):
                 part[j] += mai
             patm.append(part)
         patm.append([parts[-1]])
-        allpat = [''.join(i) for i in zip(*crossref_all(patm))]
+        allpat = [''.join(i) for i in CrossRef(patm)]
         return allpat
     else:
         return []
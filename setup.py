@@ -43,7 +43,8 @@ setup(
         'Programming Language :: Python :: 3.7',
     ],
     description="clasp is  tools for command line and subprocess script development",
-    entry_points={"console_scripts": ['clasp_template=clasp.templates:main']},
+    entry_points={"console_scripts": ['clasp_template=clasp.templates:main',
+                                     'clasp_worker=clasp.cluster:main']},
     python_requires=">=3.6",
     install_requires=requirements,
     license="Mozilla Public License 2.0 (MPL 2.0)",
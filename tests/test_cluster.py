@@ -0,0 +1,52 @@
+"""py.test for cluster.py"""
+import threading
+from multiprocessing.connection import Listener
+
+import clasp.cluster as mgr
+import clasp.script_tools as cst
+
+
+authkey = b'test'
+
+
+def start_daemon(**kwargs):
+    listener = Listener(('localhost', 0), authkey=authkey)
+    threading.Thread(target=mgr.serve, args=(listener, authkey), daemon=True,
+                     kwargs=kwargs).start()
+    return listener.address
+
+
+def start_dropping_node():
+    """node that accepts one task then disconnects"""
+    listener = Listener(('localhost', 0), authkey=authkey)
+
+    def serve():
+        conn = listener.accept()
+        conn.send(('hello', 2, 1.0))
+        conn.recv()
+        conn.close()
+        listener.close()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return listener.address
+
+
+def test_cluster_call():
+    """py.test for pool_call and cluster_call on worker daemons"""
+    nodes = [start_daemon(workers=2, backend='thread') for i in range(2)]
+    nodes.append(start_dropping_node())
+    executor = mgr.ClusterExecutor(nodes, authkey)
+    assert executor._max_workers == 6
+    args = [(2, i) for i in range(20)]
+    assert cst.pool_call(pow, args, expand=True,
+                         backend=executor) == [2**i for i in range(20)]
+    assert len(executor.nodes) == 2
+    assert cst.cluster_call(pow, [[3, 3], [1, 2]],
+                            backend=executor) == [3, 9]
+    try:
+        executor.submit(pow, 'a', 2).result()
+    except TypeError:
+        pass
+    else:
+        assert False, "remote exception not raised"
+    executor.shutdown()
@@ -1,6 +1,9 @@
 """py.test for script_tools.py"""
 import clasp.script_tools as mgr
 import os
+import time
+import asyncio
+import array
 #pytest -s -v test_script_tools.py
 
 
@@ -18,6 +21,111 @@ def test_pipeline():
     os.system("rm test.hdr")
 
 
+def test_pipeline_large_io():
+    """py.test for pipeline with large stdin/stderr"""
+    big = b"x" * 2**24
+    assert mgr.pipeline(["cat", "cat", "wc -c"], inp=big).strip() == str(2**24)
+    command = "sh -c 'cat; head -c {} /dev/zero >&2'".format(2**22)
+    out, err = mgr.pipeline([command, "cat"], inp="abc", caperr=True)
+    assert out == "abc"
+    assert len(err) == 2**22
+
+
+def test_pipeline_stats():
+    """py.test for pipeline with stats=True"""
+    out, stats = mgr.pipeline(["cat $(seq 1000)", "sort -n", "tail -1"],
+                              stats=True)
+    assert out == "1000\n"
+    assert [i['command'][:4] for i in stats.stages] == ['cat ', 'sort', 'tail']
+    assert [i['returncode'] for i in stats.stages] == [0, 0, 0]
+    assert stats.bytes_out == 5
+    assert stats.wall >= stats.slowest()['wall']
+
+
+def test_pipeline_cache(tmpdir):
+    """py.test for PipelineCache"""
+    cache = mgr.PipelineCache(str(tmpdir.join("cache")), maxsize=100)
+    inf = str(tmpdir.join("in.txt"))
+    for i in range(2):
+        assert mgr.pipeline(["cat"], inp="a", cache=cache) == "a"
+    assert cache.stats()['hits'] == 1
+    with open(inf, 'w') as f:
+        f.write("b")
+    assert mgr.pipeline(["cat"], inp=inf, forceinpfile=True,
+                        cache=cache) == "b"
+    with open(inf, 'w') as f:
+        f.write("c")
+    assert mgr.pipeline(["cat"], inp=inf, forceinpfile=True,
+                        cache=cache) == "c"
+    for i in range(10):
+        mgr.pipeline(["echo {}".format(i)], cache=cache)
+    assert cache.stats()['size'] <= 100
+    assert cache.stats()['evictions'] > 0
+
+
+def test_pipeline_iter():
+    """py.test for pipeline_iter"""
+    result = list(mgr.pipeline_iter(["cat", "sort -r"], inp="a\nb\nc\n"))
+    assert result == ['c\n', 'b\n', 'a\n']
+    result = b"".join(mgr.pipeline_iter(["cat $(printf 12)"], binary=True))
+    assert result == b"12"
+    stream = mgr.pipeline_iter(["yes", "cat"])
+    assert next(stream) == 'y\n'
+    stream.close()
+
+
+def test_subpipe():
+    """py.test for subpipe"""
+    result = mgr.pipeline(["cat $(echo a) $(echo b | tr a-z A-Z)"])
+    assert result == 'a\nB\n'
+    assert mgr.pipeline(["echo $((2*(3+1))) $((1+1))", "cat"]) == '8 2\n'
+    assert mgr.pipeline(["cat $(cat $(echo $((2*3))))"]) == '6\n'
+    result = mgr.pipeline(["cat $(echo a) $(echo b)"], subjobs=1)
+    assert result == 'a\nb\n'
+
+
+def test_subpipe_fdsub():
+    """py.test for pipe backed process substitution"""
+    temps, commands = mgr.subpipe(["cat $(echo a)"], fdsub=True)
+    assert commands == ["cat /dev/fd/{}".format(temps[0].fd)]
+    mgr._clean_temps(temps)
+    assert mgr.pipeline(["cat $(seq 3)", "sort -r"], fdsub=True) == '3\n2\n1\n'
+    assert mgr.pipeline(["head -n 2 $(yes)"], fdsub=True) == 'y\ny\n'
+    # only descriptors created by subpipe are passed to the command
+    out, err = mgr.pipeline(["cat /dev/fd/57"], caperr=True)
+    assert b"/dev/fd/57" in err
+
+
+def test_apipeline():
+    """py.test for apipeline and apipeline_gather"""
+    result = asyncio.run(mgr.apipeline(["cat", "sort -r"], inp="a\nb\nc\n"))
+    assert result == 'c\nb\na\n'
+    result = asyncio.run(mgr.apipeline(["sh -c 'echo err >&2; echo out'"],
+                                       caperr=True))
+    assert result == ('out\n', b'err\n')
+    commands = [["echo {}".format(i), "cat"] for i in range(20)]
+    result = asyncio.run(mgr.apipeline_gather(commands, limit=4))
+    assert result == ["{}\n".format(i) for i in range(20)]
+
+
+def test_pipeline_batch():
+    """py.test for pipeline_batch"""
+    commands = [["sleep 0.{}".format(3 - i), "echo {}".format(i)]
+                for i in range(3)]
+    result = mgr.pipeline_batch(commands, jobs=3)
+    assert result == ['0\n', '1\n', '2\n']
+    result = list(mgr.pipeline_batch(commands, jobs=3, order=False))
+    assert result == [(2, '2\n'), (1, '1\n'), (0, '0\n')]
+    commands = [["sleep 4.5"], ["nonexistent_cmd_xyz"], ["sleep 4.5"]]
+    try:
+        mgr.pipeline_batch(commands, jobs=3)
+    except FileNotFoundError:
+        pass
+    else:
+        assert False, "missing command not raised"
+    assert "sleep 4.5" not in mgr.pipeline(["ps -eo args"]).splitlines()
+
+
 def fac(b):
     def test(a,b):
         """return a*b!"""
@@ -37,6 +145,313 @@ def test_cluster_call():
         assert result == a
 
 
+def test_pool_call():
+    """py.test for pool_call with the shared pool"""
+    with mgr.worker_pool(2) as pool:
+        assert mgr.pool_call(abs, [-1, -2, 3]) == [1, 2, 3]
+        assert mgr.get_pool() is pool
+        cwd = os.getcwd()
+        result = mgr.pool_call(os.getcwd, [()], expand=True, cwd="/")
+        os.chdir(cwd)
+        assert result == ['/']
+        assert mgr.pool_call(os.getcwd, [()] * 2, expand=True) == [cwd] * 2
+        futures = mgr.pool_call(os.getcwd, [()], expand=True, handle=True)
+        assert futures[0].result() == cwd
+    assert 'process' not in mgr._pools
+
+
+def test_pool_imap():
+    """py.test for pool_imap"""
+    result = mgr.pool_imap(abs, (-i for i in range(10**6)), inflight=4)
+    assert [next(result) for i in range(5)] == [0, 1, 2, 3, 4]
+    result.close()
+    result = mgr.pool_imap(abs, range(-20, 0), order=False)
+    assert sorted(result) == [(i, 20 - i) for i in range(20)]
+
+
+def fail_first(i, done):
+    if i == 0:
+        raise ValueError(i)
+    time.sleep(0.2)
+    done.append(i)
+
+
+def test_pool_call_exception():
+    """py.test for pool_call waiting on running tasks before raising"""
+    done = []
+    try:
+        mgr.pool_call(fail_first, range(4), dict(done=done), backend='thread',
+                      max_workers=4)
+    except ValueError:
+        assert sorted(done) == [1, 2, 3]
+    else:
+        assert False, "task exception not raised"
+
+
+def test_pool_call_chunksize():
+    """py.test for pool_call with chunksize"""
+    args = list(range(-1000, 0))
+    answer = [abs(i) for i in args]
+    assert mgr.pool_call(abs, args, chunksize=64) == answer
+    assert mgr.pool_call(abs, args, chunksize='auto') == answer
+    args = [(2, i) for i in range(100)]
+    result = mgr.pool_call(pow, args, expand=True, chunksize=7, order=False)
+    assert sorted(result) == [2**i for i in range(100)]
+
+
+def test_pool_call_thread():
+    """py.test for pool_call with the thread backend"""
+    args = [["echo {}".format(i)] for i in range(8)]
+    result = mgr.pool_call(mgr.pipeline, args, backend='thread')
+    assert result == ["{}\n".format(i) for i in range(8)]
+    data = (fac, (range(1, 5),))
+    assert mgr.cluster_call(*data, backend='thread') == [1, 2, 6, 24]
+
+
+def nested_sum(x, backend):
+    return sum(mgr.pool_call(abs, range(-x, 0), backend=backend))
+
+
+def test_pool_call_nested():
+    """py.test for pool_call inside tasks of the shared pool"""
+    for backend in ('thread', 'process'):
+        with mgr.worker_pool(2, backend):
+            result = mgr.pool_call(nested_sum, [3, 4], dict(backend=backend),
+                                   backend=backend)
+        assert result == [6, 10]
+
+
+def load_table(n):
+    return list(range(n))
+
+
+def lookup(i):
+    return mgr.worker_state()[i]
+
+
+def test_pool_call_initializer():
+    """py.test for pool_call with initializer"""
+    for test in (False, True):
+        result = mgr.pool_call(lookup, range(5), initializer=load_table,
+                               initargs=(10,), test=test)
+        assert result == list(range(5))
+    pool = mgr.get_pool()
+    mgr.pool_call(lookup, [1], initializer=load_table, initargs=(10,))
+    assert mgr.get_pool() is pool
+
+
+def describe(buf, scale=1):
+    fmt = getattr(buf, 'format', getattr(buf, 'typecode', None))
+    return type(buf).__name__, fmt, buf[2] * scale, len(buf)
+
+
+def test_pool_call_shared_memory():
+    """py.test for pool_call passing buffers through shared memory"""
+    big = array.array('d', range(2**18))
+    result = mgr.pool_call(describe, [big, array.array('d', [1, 2, 3])],
+                           kwargs=dict(scale=2), shm=True)
+    assert result == [('memoryview', 'd', 4.0, 2**18), ('array', 'd', 6.0, 3)]
+    result = mgr.pool_call(describe, [(b"x" * 2**21,)], expand=True, shm=True)
+    assert result == [('memoryview', 'B', 120, 2**21)]
+    result = mgr.pool_call(describe, [big])
+    assert result == [('array', 'd', 2.0, 2**18)]
+
+
+def crash(i, marker):
+    if i == 3 and not os.path.exists(marker):
+        open(marker, 'w').close()
+        os._exit(1)
+    if i == 5:
+        os._exit(1)
+    return i * 2
+
+
+def test_pool_call_retries(tmpdir):
+    """py.test for pool_call recovering from a broken pool"""
+    marker = str(tmpdir.join("marker"))
+    try:
+        mgr.pool_call(crash, range(8), dict(marker=marker), retries=1)
+    except mgr.PoolCallError as ex:
+        assert ex.results == [0, 2, 4, 6, 8, None, 12, 14]
+        assert list(ex.failed.keys()) == [5]
+    else:
+        assert False, "PoolCallError not raised"
+    assert mgr.pool_call(abs, [-1, -2]) == [1, 2]
+
+
+def mark(i, d):
+    open(os.path.join(d, str(i)), 'w').close()
+    return i * 2
+
+
+def test_pool_call_journal(tmpdir):
+    """py.test for pool_call resuming from a journal"""
+    d = str(tmpdir)
+    journal = str(tmpdir.join("journal"))
+    assert mgr.pool_call(mark, range(3), dict(d=d), journal=journal) == [0, 2, 4]
+    for i in range(3):
+        os.remove(os.path.join(d, str(i)))
+    with open(journal, 'ab') as f:
+        f.write(b"\x80\x04torn")
+    assert mgr.pool_call(mark, range(5), dict(d=d), journal=journal) == [0, 2, 4, 6, 8]
+    assert sorted(os.listdir(d)) == ['3', '4', 'journal']
+    result = mgr.pool_call(mark, range(5), dict(d=d), journal=journal, order=False)
+    assert sorted(result) == [0, 2, 4, 6, 8]
+    assert sorted(os.listdir(d)) == ['3', '4', 'journal']
+
+
+def test_pool_call_cost(tmpdir):
+    """py.test for pool_call scheduling largest tasks first"""
+    args = [1, 5, 2, 4]
+    done = list(mgr.pool_imap(abs, args, order=False, cost=args, inflight=1))
+    assert [i[0] for i in done] == [1, 3, 2, 0]
+    assert mgr.pool_call(abs, args, cost=lambda x: x % 3) == args
+    model = mgr.CostModel(str(tmpdir.join("costs.json")), key=lambda x: x > 2)
+    assert mgr.pool_call(abs, args, cost=model) == args
+    model = mgr.CostModel(str(tmpdir.join("costs.json")), key=lambda x: x > 2)
+    assert model.costs['True'][0] == 2 and model.costs['False'][0] == 2
+    assert model(7) == model(5)
+
+
+def wait_pid(i):
+    time.sleep(0.02)
+    return os.getpid()
+
+
+def test_pool_call_auto():
+    """py.test for pool_call choosing inline, thread or process execution"""
+    mgr.shutdown_pool()
+    assert mgr.pool_call(os.getpid, [()] * 5, expand=True,
+                         backend='auto') == [os.getpid()] * 5
+    assert not mgr._pools
+    pids = mgr.pool_call(wait_pid, range(12), backend='auto', max_workers=4)
+    assert pids == [os.getpid()] * 12
+    assert list(mgr._pools) == ['thread']
+    mgr.shutdown_pool()
+
+
+def count_running(i, running, peak):
+    running.append(i)
+    peak.append(len(running))
+    time.sleep(0.02)
+    running.remove(i)
+    return i
+
+
+def test_jobserver(monkeypatch):
+    """py.test for pool_call drawing tokens from a make jobserver"""
+    r, w = os.pipe()
+    os.write(w, b"++")
+    monkeypatch.setenv("MAKEFLAGS", " -j3 --jobserver-auth={},{}".format(r, w))
+    mgr.set_jobs()
+    assert mgr.get_budget().jobserver
+    peak = []
+    kwargs = dict(running=[], peak=peak)
+    assert mgr.pool_call(count_running, range(12), kwargs, backend='thread',
+                         max_workers=6) == list(range(12))
+    assert max(peak) == 3
+    os.set_blocking(r, False)
+    assert os.read(r, 8) == b"++"
+    os.write(w, b"++")
+    assert mgr.get_budget().acquire()
+    nfds = len(os.listdir('/proc/self/fd'))
+    for i in range(5):
+        mgr.set_jobs()
+    assert len(os.listdir('/proc/self/fd')) == nfds
+    assert os.read(r, 8) == b"++"
+    monkeypatch.delenv("MAKEFLAGS")
+    mgr.set_jobs(2)
+    peak.clear()
+    mgr.pool_call(count_running, range(12), kwargs, backend='thread',
+                  max_workers=6)
+    assert max(peak) == 2
+    mgr.set_jobs()
+    os.close(r)
+    os.close(w)
+
+
+def test_crossref():
+    """py.test for CrossRef and crossref_all"""
+    l = [[1, 2, 3], ['a', 'b'], ['x', 'y'], [9, 8]]
+    assert mgr.crossref_all(l[:2]) == [(1, 1, 2, 2, 3, 3),
+                                      ('a', 'b', 'a', 'b', 'a', 'b')]
+    sweep = mgr.CrossRef(l, followers=[(1, 2)])
+    assert len(sweep) == 12
+    assert sweep[0] == (1, 'a', 'x', 9)
+    assert sweep[5] == (2, 'a', 'x', 8)
+    assert sweep[-1] == (3, 'b', 'y', 8)
+    assert list(sweep) == [sweep[i] for i in range(12)]
+    assert sweep[10:] == [(3, 'b', 'y', 9), (3, 'b', 'y', 8)]
+    assert len(mgr.CrossRef([range(10)] * 8)) == 10**8
+
+
+def area(w, h, unit, log):
+    with open(log, 'a') as f:
+        f.write("{} {}\n".format(w, h))
+    return w * h, unit
+
+
+def test_sweep(tmpdir):
+    """py.test for sweep skipping cells already in the store"""
+    store = str(tmpdir.join("store.tsv"))
+    log = str(tmpdir.join("log"))
+    params = [[1, 2], [3, 4], ['m', 'cm']]
+    result = mgr.sweep(area, params, store, followers=[(1, 2)],
+                       kwargs=dict(log=log), names=['w', 'h', 'unit'])
+    assert result == [[3.0, 'm'], [4.0, 'cm'], [6.0, 'm'], [8.0, 'cm']]
+    with open(store) as f:
+        assert f.readline() == "#w\th\tunit\n"
+        assert sorted(f.readlines())[0] == "1\t3\tm\t3\tm\n"
+    params[0].append(5)
+    result = mgr.sweep(area, params, store, followers=[(1, 2)],
+                       kwargs=dict(log=log))
+    assert result[:2] == [[3.0, 'm'], [4.0, 'cm']]
+    assert result[4:] == [[15.0, 'm'], [20.0, 'cm']]
+    with open(log) as f:
+        assert len(f.readlines()) == 6
+    assert mgr.sweep(abs, [[-1, -2]]) == [1, 2]
+    assert mgr.sweep(str, [['007']], backend='thread') == ['007']
+
+
+def test_read_data_array(tmpdir):
+    """py.test for read_data and read_all_data with as_array=True"""
+    dataf = str(tmpdir.join("data.tsv"))
+    with open(dataf, 'w') as f:
+        f.write("x\ty\tz\n1\t2\t3\n2\tNA\t5\n3\t4\t6\n")
+    lists = mgr.read_data(dataf, [0], [1, 2], header=True)
+    arrays = mgr.read_data(dataf, [0], [1, 2], header=True, as_array=True)
+    assert lists[1] == [[2.0, 4.0], [3.0, 5.0, 6.0]]
+    for a, b in zip(lists[:2], arrays[:2]):
+        assert [list(i) for i in a] == [list(i) for i in b]
+    assert arrays[2] == ['y', 'z']
+    xs, ys, head = mgr.read_all_data([dataf, dataf], [(0, 0)], [(1, 2)],
+                                     header=True, as_array=True)
+    assert list(ys[0]) == [3.0, 5.0, 6.0] and head == ['z']
+    if mgr.np is not None:
+        ys = mgr.read_data(dataf, [0], [1], header=True, coerce=False,
+                           as_array=True)[1]
+        assert mgr.np.isnan(ys[0][1])
+
+
+def test_read_all_data(tmpdir, monkeypatch):
+    """py.test for read_all_data parsing each file once"""
+    dataf = str(tmpdir.join("data.tsv"))
+    with open(dataf, 'w') as f:
+        f.write("x\ty\tz\n1\t2\t3\n2\t4\t5\n")
+    parsed = []
+    read_data_file = mgr.read_data_file
+
+    def counted(*args, **kwargs):
+        parsed.append(args[0])
+        return read_data_file(*args, **kwargs)
+    monkeypatch.setattr(mgr, "read_data_file", counted)
+    xs, ys, head = mgr.read_all_data([dataf], [0], [1, 2], header=True)
+    assert xs == [[1.0, 2.0], [1.0, 2.0]]
+    assert ys == [[2.0, 4.0], [3.0, 5.0]]
+    assert head == ['y', 'z']
+    assert parsed == [dataf]
+
+
 def test_kwarg_match():
     """py.test for kwarg_match"""
     
@@ -54,6 +469,24 @@ def test_kwarg_match():
     assert mgr.kwarg_match(crop_reg, data) == answer
 
 
+def test_arg_binder():
+    """py.test for cached ArgBinder"""
+
+    def func(a, b, c=1, d=2):
+        pass
+    assert mgr.arg_binder(func) is mgr.arg_binder(func)
+    assert mgr.arg_match(func, dict(c=3), 9) == [9, None, 3, None]
+    assert mgr.kwarg_arg(func, dict(d=5)) == [1, 5]
+    func.__defaults__ = (7, 8)
+    assert mgr.kwarg_arg(func, {}) == [7, 8]
+
+    class Task(object):
+        def run(self, x, y=2):
+            pass
+    assert mgr.kwarg_match(Task().run, dict(y=1, z=0)) == dict(y=1)
+    assert mgr.arg_binder(Task().run) is mgr.arg_binder(Task().run)
+
+
 def test_kwarg_arg():
     """py.test for kwarg_match"""
     